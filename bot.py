@@ -9,8 +9,6 @@ import time
 import json
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from PIL import Image, ImageDraw, ImageFont
-import textwrap
 import os
 import sys
 import datetime
@@ -18,6 +16,20 @@ import random
 from dotenv import load_dotenv
 import asyncio
 import logging
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from image_cache import ImageCache, cache_key
+from scheduling import DueScheduler
+from broadcast import BroadcastEngine
+from botapi import AsyncBotAPI
+from render import FontRegistry, CardRenderer, RenderService, Encoding, ENCODERS, TEMPLATES, DEFAULT_TEMPLATE
+from quotes import QuotePool, SeenQuotes, HedgedFetcher, CircuitBreaker
+from corpus import QuoteCorpus, format_quote
+from storage import (WriteBehind, SQLiteStore, Journal, LazyChatMap, ChatShards, ShardField,
+                     ShardUserStats, new_shard, normalize_state)
+from snapshot import SnapshotReader, encode_snapshot, write_binary_snapshot
+from leases import LeaseTable
+from coalesce import EditCoalescer
 
 # Set up Flask app for webhooks
 flask_app = Flask(__name__)
@@ -57,6 +69,7 @@ chat_settings = {}
 subscribed_chats = set()
 reaction_counts = {}
 user_reactions = {}
+reactions_lock = Lock()
 chat_schedules = {}
 last_quote_times = {}
 leaderboard_data = {}
@@ -69,38 +82,384 @@ help_message_ids = {}
 welcome_messages = {}
 command_cooldowns = {}
 user_stats = {}  # {user_id: {chat_id: {join_date, reactions_given, quote_requests}}}
+data_lock = threading.RLock()
 COOLDOWN_SECONDS = 30
 DATA_FILE = "bot_data.json"
+SNAPSHOT_FILE = "bot_data.snap"
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT", "json").lower()  # json or binary
+SQLITE_FILE = "bot_data.db"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()  # json or sqlite
+SAVE_INTERVAL_SECONDS = 5
+SAVE_DIRTY_THRESHOLD = 100
+COMPACT_INTERVAL_SECONDS = 600
+COMPACT_JOURNAL_BYTES = 4 * 1024 * 1024
+store = None  # SQLiteStore when STORAGE_BACKEND is sqlite
+journal = None  # Journal of events since the last snapshot (json backend)
+snapshot_reader = None  # SnapshotReader backing lazily decoded leaderboards
+SHARDED_STATE = os.getenv("SHARDED_STATE", "0") == "1"
+SHARD_DIR = "shards"
+MAX_LOADED_CHATS = int(os.getenv("MAX_LOADED_CHATS", 500))
+CHAT_IDLE_SECONDS = 1800
+shards = None  # ChatShards holding per-chat state when SHARDED_STATE is on
+leaderboard_prune_keys = None  # (day, week) of the last prune, applied on lazy decode
+
+def load_snapshot_chat(chat_id):
+    users = snapshot_reader.leaderboard(chat_id)
+    if leaderboard_prune_keys:
+        prune_buckets(users, *leaderboard_prune_keys)
+    return users
+
+def load_snapshot():
+    global snapshot_reader
+    candidates = [path for path in (DATA_FILE, SNAPSHOT_FILE) if os.path.exists(path)]
+    if not candidates:
+        return normalize_state({}), 0
+    if max(candidates, key=os.path.getmtime) == SNAPSHOT_FILE:
+        # Binary snapshot: leaderboards stay in the mmap until a chat is touched
+        snapshot_reader = SnapshotReader(SNAPSHOT_FILE)
+        quote_counts, chat_settings = snapshot_reader.quote_counts_and_settings()
+        subscribed, schedules, last_sent = snapshot_reader.schedules()
+        return {
+            'leaderboard_data': LazyChatMap(load_snapshot_chat, snapshot_reader.chat_ids()),
+            'quote_counts': quote_counts,
+            'chat_settings': chat_settings,
+            'total_quote_count': snapshot_reader.total_quote_count,
+            'user_stats': snapshot_reader.user_stats(),
+            'subscribed_chats': subscribed,
+            'chat_schedules': schedules,
+            'last_quote_times': last_sent
+        }, snapshot_reader.journal_seq
+    with open(DATA_FILE, 'r') as f:
+        raw = json.load(f)
+    data = normalize_state(raw)
+    data['sharded'] = raw.get('sharded', False)
+    return data, raw.get('journal_seq', 0)
+
+def prune_loaded_shard(shard):
+    if leaderboard_prune_keys:
+        prune_buckets(shard['leaderboard'], *leaderboard_prune_keys)
+
+def open_shards():
+    global shards
+    shards = ChatShards(SHARD_DIR, max_chats=MAX_LOADED_CHATS, idle_seconds=CHAT_IDLE_SECONDS)
+    shards.on_load = prune_loaded_shard
+    return shards
+
+# Move a fully loaded state into per-chat shards (first start with SHARDED_STATE)
+def split_into_shards(data):
+    shards.reset()
+    per_chat = {}
+    for chat_id, users in data['leaderboard_data'].items():
+        per_chat.setdefault(chat_id, new_shard())['leaderboard'] = users
+    for user_id, chats in data['user_stats'].items():
+        for chat_id, stats in chats.items():
+            per_chat.setdefault(chat_id, new_shard())['user_stats'][user_id] = stats
+    for chat_id, shard in per_chat.items():
+        shards.put(chat_id, shard)
+    logger.info(f"Split state into {len(per_chat)} chat shards")
+
+# Rebuild plain dicts from shards (SHARDED_STATE turned off again)
+def merge_shards():
+    leaderboard = {}
+    stats = {}
+    for chat_id, shard in ChatShards(SHARD_DIR).read_all().items():
+        if shard['leaderboard']:
+            leaderboard[chat_id] = shard['leaderboard']
+        for user_id, entry in shard['user_stats'].items():
+            stats.setdefault(user_id, {})[chat_id] = entry
+    return leaderboard, stats
 
 # Load persistent data
 def load_data():
-    global leaderboard_data, quote_counts, chat_settings, total_quote_count, user_stats
+    global leaderboard_data, quote_counts, chat_settings, total_quote_count, user_stats, store, journal
+    global subscribed_chats, chat_schedules, last_quote_times
+    global latest_quotes, start_message_ids, help_message_ids
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                leaderboard_data = data.get('leaderboard_data', {})
-                quote_counts = data.get('quote_counts', {})
-                chat_settings = data.get('chat_settings', {})
-                total_quote_count = data.get('total_quote_count', 0)
-                user_stats = data.get('user_stats', {})
-            logger.info("Data loaded successfully")
+        journal_seq = 0
+        migrate_to_shards = False
+        if STORAGE_BACKEND == "sqlite":
+            store = SQLiteStore(SQLITE_FILE)
+            store.migrate_json(DATA_FILE)
+            data = store.load()
+        else:
+            data, journal_seq = load_snapshot()
+            sharded_snapshot = data.pop('sharded', False)
+            if SHARDED_STATE:
+                open_shards()
+                migrate_to_shards = not sharded_snapshot
+            elif sharded_snapshot:
+                data['leaderboard_data'], data['user_stats'] = merge_shards()
+        with data_lock:
+            quote_counts = data['quote_counts']
+            chat_settings = data['chat_settings']
+            total_quote_count = data['total_quote_count']
+            subscribed_chats = data['subscribed_chats']
+            chat_schedules = data['chat_schedules']
+            last_quote_times = data['last_quote_times']
+            if shards is not None:
+                if migrate_to_shards:
+                    split_into_shards(data)
+                leaderboard_data = ShardField(shards, 'leaderboard')
+                user_stats = ShardUserStats(shards)
+                latest_quotes = ShardField(shards, 'latest_quote')
+                start_message_ids = ShardField(shards, 'start_message_id')
+                help_message_ids = ShardField(shards, 'help_message_id')
+            else:
+                leaderboard_data = data['leaderboard_data']
+                user_stats = data['user_stats']
+            if store is None:
+                # Snapshot first, then the journal tail written after it
+                journal = Journal(DATA_FILE + ".journal")
+                replayed = 0
+                for seq, event in journal.replay(journal_seq):
+                    if shards is not None and event[0] in ('message', 'user_stat'):
+                        # Shards written by an interrupted compaction already include it
+                        chat_id = event[1] if event[0] == 'message' else event[2]
+                        if shards.applied_seq(chat_id) >= seq:
+                            continue
+                    apply_event(event)
+                    replayed += 1
+                journal.discard_through(journal_seq)
+                journal.open(journal_seq)
+                logger.info(f"Replayed {replayed} journal events after snapshot {journal_seq}")
+        if migrate_to_shards:
+            compact_data()
+        logger.info(f"Data loaded successfully ({STORAGE_BACKEND} backend)")
     except Exception as e:
         logger.error(f"Data load error: {e}")
 
+def leaderboard_items():
+    if isinstance(leaderboard_data, LazyChatMap):
+        return leaderboard_data.snapshot_items()
+    return leaderboard_data.items()
+
+def schedule_state():
+    return {
+        'subscribed_chats': sorted(subscribed_chats),
+        'chat_schedules': chat_schedules,
+        'last_quote_times': last_quote_times
+    }
+
+def snapshot_payload(journal_seq=0):
+    with data_lock:
+        return json.dumps({
+            'leaderboard_data': dict(leaderboard_items()),
+            'quote_counts': quote_counts,
+            'chat_settings': chat_settings,
+            'total_quote_count': total_quote_count,
+            'user_stats': user_stats,
+            **schedule_state(),
+            'journal_seq': journal_seq
+        })
+
+def write_snapshot(payload):
+    tmp_file = DATA_FILE + ".tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, DATA_FILE)
+
 def save_data():
     try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump({
-                'leaderboard_data': leaderboard_data,
-                'quote_counts': quote_counts,
-                'chat_settings': chat_settings,
-                'total_quote_count': total_quote_count,
-                'user_stats': user_stats
-            }, f)
+        flush_seen_quotes()
+        if store is not None:
+            return store.commit()
+        if journal is not None:
+            return journal.sync()
+        write_snapshot(snapshot_payload())
         logger.info("Data saved")
+        return True
     except Exception as e:
         logger.error(f"Data save error: {e}")
+        return False
+
+# Fold sealed journal segments into a fresh snapshot
+def compact_data():
+    global snapshot_reader
+    if journal is None:
+        return False
+    try:
+        if shards is not None:
+            with data_lock:
+                sealed = journal.rotate()
+                dumped = shards.dump_dirty(sealed)
+                payload = json.dumps({
+                    'sharded': True,
+                    'quote_counts': quote_counts,
+                    'chat_settings': chat_settings,
+                    'total_quote_count': total_quote_count,
+                    **schedule_state(),
+                    'journal_seq': sealed
+                })
+            shards.write_dumped(dumped)
+            write_snapshot(payload)
+            with data_lock:
+                shards.evict()
+        elif SNAPSHOT_FORMAT == "binary":
+            with data_lock:
+                sealed = journal.rotate()
+                payload = encode_snapshot({
+                    'quote_counts': quote_counts,
+                    'chat_settings': chat_settings,
+                    'total_quote_count': total_quote_count,
+                    'user_stats': user_stats,
+                    'subscribed_chats': subscribed_chats,
+                    'chat_schedules': chat_schedules,
+                    'last_quote_times': last_quote_times
+                }, leaderboard_items(), sealed)
+            write_binary_snapshot(SNAPSHOT_FILE, payload)
+            if isinstance(leaderboard_data, LazyChatMap):
+                # Undecoded chats are identical in the new file; read them from there
+                with data_lock:
+                    snapshot_reader = SnapshotReader(SNAPSHOT_FILE)
+                    leaderboard_data.set_loader(load_snapshot_chat)
+        else:
+            with data_lock:
+                sealed = journal.rotate()
+                payload = snapshot_payload(sealed)
+            write_snapshot(payload)
+        journal.discard_through(sealed)
+        logger.info(f"Journal compacted into snapshot {sealed}")
+        return True
+    except Exception as e:
+        logger.error(f"Journal compaction error: {e}")
+        return False
+
+def journal_compactor():
+    logger.info("Starting journal compactor...")
+    last_compact = time.time()
+    while True:
+        time.sleep(30)
+        if journal is None:
+            continue
+        if shards is not None:
+            with data_lock:
+                shards.evict()
+            if shards.over_budget():
+                # Only dirty shards are left over budget; compaction makes them evictable
+                compact_data()
+                last_compact = time.time()
+                continue
+        if journal.size >= COMPACT_JOURNAL_BYTES or time.time() - last_compact >= COMPACT_INTERVAL_SECONDS:
+            if journal.size:
+                compact_data()
+            last_compact = time.time()
+
+# Handlers only mark state dirty; the write-behind thread saves it in batches
+persistence = WriteBehind(save_data, interval=SAVE_INTERVAL_SECONDS, max_dirty=SAVE_DIRTY_THRESHOLD)
+
+def mark_dirty():
+    persistence.mark_dirty()
+
+def flush_data():
+    flush_seen_quotes()
+    return persistence.flush()
+
+atexit.register(flush_data)
+
+# State Events
+# Every persisted change is a small event tuple, applied to the in-memory
+# state and mirrored to the storage backend (single-row upserts for SQLite,
+# a journal append for the JSON snapshot):
+#   ('message', chat_id, user_id, name, day_key, week_key)
+#   ('user_stat', user_id, chat_id, field or None, join_date)
+#   ('quote', chat_id)
+#   ('setting', chat_id, send_type)
+#   ('forget_chat', chat_id)
+#   ('prune', day_key, week_key)
+#   ('subscription', chat_id, subscribed)
+#   ('interval', chat_id, seconds)  - also restarts the chat's schedule
+#   ('sent', chat_id, timestamp)    - last scheduled quote
+def apply_event(event):
+    global total_quote_count, leaderboard_prune_keys
+    kind = event[0]
+    if kind == 'message':
+        _, chat_id, user_id, name, day, week = event
+        user_data = leaderboard_data.setdefault(chat_id, {}).setdefault(user_id, {
+            "name": name,
+            "daily": {},
+            "weekly": {},
+            "overall": 0
+        })
+        user_data["name"] = name
+        user_data["overall"] += 1
+        user_data["daily"][day] = user_data["daily"].get(day, 0) + 1
+        user_data["weekly"][week] = user_data["weekly"].get(week, 0) + 1
+        if shards is not None:
+            shards.mark_dirty(chat_id)
+    elif kind == 'user_stat':
+        _, user_id, chat_id, field, join_date = event
+        stats = user_stats.setdefault(user_id, {}).setdefault(chat_id, {
+            'join_date': join_date,
+            'reactions_given': 0,
+            'quote_requests': 0
+        })
+        if field:
+            stats[field] += 1
+    elif kind == 'quote':
+        _, chat_id = event
+        with total_quote_count_lock:
+            quote_counts[chat_id] = quote_counts.get(chat_id, 0) + 1
+            total_quote_count += 1
+    elif kind == 'setting':
+        _, chat_id, send_type = event
+        chat_settings[chat_id] = send_type
+    elif kind == 'forget_chat':
+        _, chat_id = event
+        if shards is not None:
+            shards.drop(chat_id)
+            quote_counts.pop(chat_id, None)
+        else:
+            for data in [leaderboard_data, latest_quotes, quote_counts, start_message_ids, help_message_ids]:
+                if chat_id in data:
+                    del data[chat_id]
+        subscribed_chats.discard(chat_id)
+        chat_schedules.pop(chat_id, None)
+        last_quote_times.pop(chat_id, None)
+    elif kind == 'subscription':
+        _, chat_id, subscribed = event
+        if subscribed:
+            subscribed_chats.add(chat_id)
+        else:
+            subscribed_chats.discard(chat_id)
+    elif kind == 'interval':
+        _, chat_id, interval = event
+        chat_schedules[chat_id] = interval
+        last_quote_times[chat_id] = 0
+    elif kind == 'sent':
+        _, chat_id, sent_at = event
+        last_quote_times[chat_id] = sent_at
+    elif kind == 'prune':
+        _, day, week = event
+        leaderboard_prune_keys = (day, week)
+        if shards is not None:
+            chats = [shard['leaderboard'] for shard in shards.loaded_shards()]
+        elif isinstance(leaderboard_data, LazyChatMap):
+            chats = leaderboard_data.loaded_values()
+        else:
+            chats = leaderboard_data.values()
+        for users in chats:
+            prune_buckets(users, day, week)
+
+def prune_buckets(users, day, week):
+    for data in users.values():
+        data["daily"] = {k: v for k, v in data["daily"].items() if k >= day}
+        data["weekly"] = {k: v for k, v in data["weekly"].items() if k >= week}
+
+def record_event(event):
+    with data_lock:
+        apply_event(event)
+        if store is not None:
+            store.apply(event)
+        elif journal is not None:
+            journal.append(event)
+    mark_dirty()
+    if leases is not None and event[0] in LEASE_EVENTS:
+        publish_schedules([event[1]], reset=event[0] == 'interval')
+
+def record_user_stat(user_id, chat_id, field=None):
+    record_event(('user_stat', user_id, chat_id, field, datetime.datetime.now().isoformat()))
 
 # Photos for /start and /help
 photos = [
@@ -140,127 +499,292 @@ REACTIONS = {
     'dislike': '👎',
 }
 
-# Font Setup
-font_paths = [
-    "fonts/NotoSansDevanagari-Regular.ttf",
-    "fonts/LiberationSans-Regular.ttf",  # Replaced arial.ttf with LiberationSans-Regular.ttf
-    "fonts/DejaVuSans.ttf",
-    "fonts/DroidSans.ttf"
-]
+# Font Setup: faces are opened on first use and picked per script by the registry
+font_registry = FontRegistry()
+
+# Shared HTTP session: one keep-alive connection pool for the lifetime of main_loop
+QUOTE_API_URL = "https://hindi-quotes.vercel.app/random"
+QUOTE_FETCH_TIMEOUT = aiohttp.ClientTimeout(total=8, connect=3, sock_read=5)
+http_session = None
+
+async def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=QUOTE_FETCH_TIMEOUT)
+        logger.info("HTTP session created")
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        logger.info("HTTP session closed")
+    http_session = None
+
+# Telegram calls made on the event loop go through the async client on the same session
+bot_api = AsyncBotAPI(TOKEN, get_http_session)
+
+# Offline quote corpus: every fetched quote is kept, and it serves when the API cannot
+CORPUS_PATH = "quotes"
+quote_corpus = None
+
+def get_quote_corpus():
+    global quote_corpus
+    if quote_corpus is None:
+        try:
+            quote_corpus = QuoteCorpus(CORPUS_PATH)
+            logger.info(f"Quote corpus opened with {len(quote_corpus)} quotes")
+        except Exception as e:
+            logger.error(f"Quote corpus error: {e}")
+    return quote_corpus
 
-def load_font(font_path, size):
-    try:
-        if os.path.exists(font_path):
-            return ImageFont.truetype(font_path, size)
-        return None
-    except Exception:
+# Quote Fetch
+async def fetch_quote_once():
+    session = await get_http_session()
+    async with session.get(QUOTE_API_URL, timeout=QUOTE_FETCH_TIMEOUT) as res:
+        if res.status == 200:
+            data = await res.json()
+            return format_quote(data)
+        logger.error(f"Quote API returned status {res.status}")
         return None
 
-hindi_font = None
-english_font = None
-title_font = None
-content_font = None
-
-for font_path in font_paths:
-    if hindi_font is None:
-        hindi_font = load_font(font_path, 40)
-    if english_font is None:
-        english_font = load_font(font_path, 40)
-    if title_font is None:
-        title_font = load_font(font_path, 60)
-    if content_font is None:
-        content_font = load_font(font_path, 40)
-
-if hindi_font is None or english_font is None or title_font is None or content_font is None:
-    try:
-        hindi_font = hindi_font or ImageFont.load_default()
-        english_font = english_font or ImageFont.load_default()
-        title_font = title_font or ImageFont.load_default()
-        content_font = content_font or ImageFont.load_default()
-        logger.warning("Using default fonts")
-    except Exception as e:
-        logger.error(f"Font loading error: {e}")
-        hindi_font = None
+# Hedged after the p95 latency, and skipped entirely while the breaker is open
+quote_fetcher = HedgedFetcher(fetch_quote_once, CircuitBreaker(failure_threshold=5, reset_timeout=30))
 
-# Quote Fetch
-async def get_hindi_quote():
+async def fetch_remote_quote():
     logger.info("Fetching Hindi quote...")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://hindi-quotes.vercel.app/random") as res:
-                if res.status == 200:
-                    data = await res.json()
-                    quote = f"{data.get('quote', '')}\n\n— {data.get('type', 'अनजान')}"
-                    logger.info("Quote fetched successfully")
-                    return quote
-                return None
+        quote = await quote_fetcher.fetch()
+        if quote:
+            logger.info("Quote fetched successfully")
+            corpus = get_quote_corpus()
+            if corpus is not None and not broadcast_worker:
+                corpus.add(quote)
+        return quote
     except Exception as e:
         logger.error(f"Error fetching quote: {e}")
         return None
 
-# Image Quote Generator
-def generate_quote_image(quote_text):
-    logger.info("Generating quote image...")
+async def get_hindi_quote():
+    quote = await fetch_remote_quote()
+    if quote:
+        return quote
+    corpus = get_quote_corpus()
+    quote = corpus.random() if corpus is not None else None
+    if quote:
+        logger.warning("Quote API unavailable, serving from local corpus")
+    return quote
+
+# Ready-to-serve quotes, refilled in the background by quote_pool.run() on main_loop
+quote_pool = QuotePool(fetch_remote_quote, capacity=20, low_water=5)
+
+# Recently delivered quotes per chat, so groups don't get the same quote again
+SEEN_FILE = "bot_data.seen"
+SEEN_QUOTES_PER_CHAT = 200
+NO_REPEAT_ATTEMPTS = 5
+seen_quotes = None
+
+def get_seen_quotes():
+    global seen_quotes
+    if seen_quotes is None:
+        try:
+            seen_quotes = SeenQuotes(SEEN_FILE, ring_size=SEEN_QUOTES_PER_CHAT)
+        except Exception as e:
+            logger.error(f"Seen quotes error: {e}")
+    return seen_quotes
+
+def is_seen(chat_id, quote):
+    seen = get_seen_quotes()
+    return chat_id is not None and seen is not None and seen.seen(chat_id, quote)
+
+def mark_seen(chat_id, quote):
+    seen = get_seen_quotes()
+    if seen is not None:
+        seen.add(chat_id, quote)
+
+# The rings are an mmap; this writes them out with the rest of the state
+def flush_seen_quotes():
+    if seen_quotes is not None:
+        seen_quotes.flush()
+
+# Non-blocking: a pooled quote this chat has not seen recently, or None
+def pop_fresh_quote(chat_id=None):
+    for _ in range(NO_REPEAT_ATTEMPTS):
+        quote = quote_pool.pop()
+        if quote is None or not is_seen(chat_id, quote):
+            return quote
+        quote_pool.put_back(quote)
+    return None
+
+async def next_quote(chat_id=None):
+    quote = pop_fresh_quote(chat_id)
+    if quote:
+        return quote
+    for _ in range(NO_REPEAT_ATTEMPTS):
+        quote = await get_hindi_quote()
+        if not quote or not is_seen(chat_id, quote):
+            break
+    return quote
+
+# Pop quotes from the pool; only missing ones are fetched live (from a webhook thread)
+def take_quotes(count, chat_id=None, timeout=10):
+    quotes = [pop_fresh_quote(chat_id) for _ in range(count)]
+    futures = [
+        asyncio.run_coroutine_threadsafe(next_quote(chat_id), main_loop) if quote is None else None
+        for quote in quotes
+    ]
+    return [future.result(timeout=timeout) if future is not None else quote
+            for quote, future in zip(quotes, futures)]
+
+# Rendered cards are cached by quote text and everything that affects the pixels
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR")  # optional on-disk tier
+IMAGE_CACHE_DISK_BYTES = 256 * 1024 * 1024
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").strip().lower()  # jpeg, pjpeg, webp or png
+if IMAGE_FORMAT not in ENCODERS:
+    logger.warning(f"Unknown IMAGE_FORMAT {IMAGE_FORMAT!r}, using jpeg")
+    IMAGE_FORMAT = "jpeg"
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 48 * 1024))  # 0 disables the budget
+image_encoding = Encoding(IMAGE_FORMAT, IMAGE_MAX_BYTES)
+image_cache = ImageCache(IMAGE_CACHE_BYTES, disk_dir=IMAGE_CACHE_DIR, disk_max_bytes=IMAGE_CACHE_DISK_BYTES)
+card_renderer = CardRenderer(font_registry)
+
+# Image chats store their template in the send type, e.g. "img:dark"
+def chat_template(chat_id):
+    send_type = chat_settings.get(chat_id, 'text')
+    return send_type.split(':', 1)[1] if ':' in send_type else DEFAULT_TEMPLATE
+
+def image_cache_key(quote_text, template=DEFAULT_TEMPLATE):
+    return cache_key(*image_encoding.cache_parts(), *card_renderer.cache_parts(template), quote_text)
+
+# Cards are rendered in worker processes; RENDER_WORKERS=0 renders inline instead
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS") or os.cpu_count() or 1)
+RENDER_MAX_PENDING = 32
+RENDER_JOB_TIMEOUT = 15
+render_service = RenderService(workers=RENDER_WORKERS, max_pending=RENDER_MAX_PENDING,
+                               job_timeout=RENDER_JOB_TIMEOUT)
+
+def start_render_service():
+    if RENDER_WORKERS <= 0:
+        logger.info("Render workers disabled, rendering inline")
+        return
+    try:
+        render_service.start()
+    except Exception as e:
+        logger.error(f"Render service failed to start, rendering inline: {e}")
+        render_service.stop()
+
+def render_inline(quote_text, template):
     try:
-        img = Image.new('RGB', (1080, 1080), color=(255, 255, 255))
-        draw = ImageDraw.Draw(img)
-
-        title = "🌟 आज का विचार 🌟"
-        title_bbox = draw.textbbox((0, 0), title, font=title_font)
-        title_w = title_bbox[2] - title_bbox[0]
-        draw.text(((1080 - title_w)/2, 100), title, font=title_font, fill=(0, 0, 0))
-
-        parts = quote_text.split('\n\n— ')
-        quote = parts[0]
-        author = "— " + parts[1] if len(parts) > 1 else ""
-
-        y_position = 300
-        for line in quote.split('\n'):
-            wrapped_lines = textwrap.wrap(line, width=30)
-            for wrapped_line in wrapped_lines:
-                bbox = draw.textbbox((0, 0), wrapped_line, font=content_font)
-                w = bbox[2] - bbox[0]
-                draw.text(((1080 - w)/2, y_position), wrapped_line, 
-                         font=content_font, fill=(50, 50, 50))
-                y_position += 60
-
-        if author:
-            bbox = draw.textbbox((0, 0), author, font=content_font)
-            w = bbox[2] - bbox[0]
-            draw.text((1080 - w - 100, 800), author, 
-                     font=content_font, fill=(100, 100, 100))
-
-        draw.line([(100, 900), (980, 900)], fill=(200, 200, 200), width=2)
-
-        watermark = "© H2I Quotes"
-        bbox = draw.textbbox((0, 0), watermark, font=content_font)
-        w = bbox[2] - bbox[0]
-        draw.text((1080 - w - 50, 950), watermark, 
-                 font=content_font, fill=(150, 150, 150))
-
-        img_bytes = BytesIO()
-        img.save(img_bytes, format='JPEG', quality=95)
-        img_bytes.seek(0)
-        logger.info("Quote image generated successfully")
-        return img_bytes
+        return card_renderer.render(quote_text, template, image_encoding)
     except Exception as e:
         logger.error(f"Image generation failed: {e}")
         return None
 
+def cached_quote_image(quote_text, template):
+    key = image_cache_key(quote_text, template)
+    data = image_cache.get(key)
+    if data is not None:
+        logger.info("Quote image served from cache")
+    return key, data
+
+def cache_quote_image(key, data, start):
+    image_cache.put(key, data, (time.perf_counter() - start) * 1000)
+    logger.info("Quote image generated successfully")
+    return BytesIO(data)
+
+# Image Quote Generator (blocking; for the telebot handler threads)
+def generate_quote_image(quote_text, template=DEFAULT_TEMPLATE):
+    key, data = cached_quote_image(quote_text, template)
+    if data is not None:
+        return BytesIO(data)
+    logger.info(f"Generating quote image ({template})...")
+    start = time.perf_counter()
+    if render_service.running():
+        data = render_service.render(quote_text, template, image_encoding)
+    else:
+        data = render_inline(quote_text, template)
+    return cache_quote_image(key, data, start) if data else None
+
+# Same for coroutines: the event loop only waits, it never renders
+async def generate_quote_image_async(quote_text, template=DEFAULT_TEMPLATE):
+    key, data = cached_quote_image(quote_text, template)
+    if data is not None:
+        return BytesIO(data)
+    logger.info(f"Generating quote image ({template})...")
+    start = time.perf_counter()
+    if render_service.running():
+        data = await render_service.render_async(quote_text, template, image_encoding)
+    else:
+        data = await asyncio.get_running_loop().run_in_executor(None, render_inline, quote_text, template)
+    return cache_quote_image(key, data, start) if data else None
+
 # Reaction Button Creation
-def create_reaction_buttons(chat_id, message_id):
+# callback_data is just the reaction key: the handler reads the chat and message
+# from the callback itself, so the keyboard can go out with the message.
+# Older buttons carry "key:chat_id:message_id" and are still accepted.
+def create_reaction_buttons(chat_id, message_id=None, quote=None):
     markup = types.InlineKeyboardMarkup()
     counts = reaction_counts.get((chat_id, message_id), {k: 0 for k in REACTIONS})
     buttons = [
         types.InlineKeyboardButton(
             f"{REACTIONS[key]} {counts[key]}" if counts[key] > 0 else REACTIONS[key],
-            callback_data=f"{key}:{chat_id}:{message_id}"
+            callback_data=key
         ) for key in REACTIONS
     ]
     markup.add(*buttons)
-    markup.add(types.InlineKeyboardButton("📤 Share", switch_inline_query=latest_quotes.get(chat_id, "")))
+    share = quote if quote is not None else latest_quotes.get(chat_id, "")
+    markup.add(types.InlineKeyboardButton("📤 Share", switch_inline_query=share))
     return markup
 
+# Share text already on a message's keyboard, so redraws keep the quote it was sent with
+def share_query(message):
+    try:
+        return message.reply_markup.keyboard[-1][-1].switch_inline_query
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+# Works for errors from both telebot and the async client
+def telegram_retry_after(e):
+    if getattr(e, 'error_code', None) != 429:
+        return None
+    return ((getattr(e, 'result_json', None) or {}).get('parameters') or {}).get('retry_after', 5)
+
+# Errors no retry can fix: the bot was blocked, kicked or muted, or the chat is gone
+PERMANENT_ERRORS = ("chat not found", "chat_write_forbidden", "not enough rights", "have no rights",
+                    "group chat was upgraded", "peer_id_invalid", "bot is not a member")
+
+def telegram_permanent_error(e):
+    code = getattr(e, 'error_code', None)
+    if code == 403:
+        return True
+    description = str(getattr(e, 'description', e)).lower()
+    return code == 400 and any(marker in description for marker in PERMANENT_ERRORS)
+
+# Reaction keyboard edits: clicks on one message within REACTION_EDIT_WINDOW
+# become a single edit with the latest counts, and unchanged keyboards are
+# never sent.
+REACTION_EDIT_WINDOW = 1.0
+
+def render_reaction_keyboard(key, share):
+    chat_id, message_id = key
+    with reactions_lock:
+        return create_reaction_buttons(chat_id, message_id, quote=share).to_json()
+
+def edit_reaction_keyboard(key, markup):
+    chat_id, message_id = key
+    bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
+
+reaction_edits = EditCoalescer(render_reaction_keyboard, edit_reaction_keyboard, window=REACTION_EDIT_WINDOW,
+                               retry_after=telegram_retry_after)
+
 # Admin Check
 def is_admin(chat_id, user_id):
     try:
@@ -356,7 +880,7 @@ def help_command(message):
         "🏆 <b>/leaderboard</b> - Check group message rankings\n"
         "📈 <b>/mystats</b> - See your personal message stats\n"
         "👤 <b>/profile</b> - View your profile and activity\n"
-        "⚙️ <b>/settype [text/img]</b> - Set quote format (Admin)\n"
+        "⚙️ <b>/settype [text/img] [template]</b> - Set quote format and card template (Admin)\n"
         "⏰ <b>/setquotetime</b> - Schedule quotes (Admin)\n"
         "👋 <b>/setwelcome <message></b> - Set welcome message (Admin)\n"
         "🗳️ <b>/pollquote</b> - Create a quote comparison poll\n"
@@ -444,29 +968,28 @@ def handle_reaction(call):
     chat_id = getattr(call.message.chat, 'id', None)
     logger.info(f"Processing reaction callback in chat {chat_id}")
     try:
-        reaction, chat_id_str, message_id_str = call.data.split(':')
-        chat_id = int(chat_id_str)
-        message_id = int(message_id_str)
+        parts = call.data.split(':')
+        reaction = parts[0]
+        if len(parts) == 3:
+            chat_id, message_id = int(parts[1]), int(parts[2])
+        else:
+            chat_id, message_id = call.message.chat.id, call.message.message_id
         user_id = call.from_user.id
         key = (chat_id, message_id)
-        if key not in reaction_counts:
-            reaction_counts[key] = {k: 0 for k in REACTIONS}
-        if key not in user_reactions:
-            user_reactions[key] = {}
-        if user_id in user_reactions[key]:
-            old_reaction = user_reactions[key][user_id]
-            reaction_counts[key][old_reaction] -= 1
-        user_reactions[key][user_id] = reaction
-        reaction_counts[key][reaction] += 1
-        markup = create_reaction_buttons(chat_id, message_id)
-        bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
+        with reactions_lock:
+            if key not in reaction_counts:
+                reaction_counts[key] = {k: 0 for k in REACTIONS}
+            if key not in user_reactions:
+                user_reactions[key] = {}
+            if user_id in user_reactions[key]:
+                old_reaction = user_reactions[key][user_id]
+                reaction_counts[key][old_reaction] -= 1
+            user_reactions[key][user_id] = reaction
+            reaction_counts[key][reaction] += 1
         bot.answer_callback_query(call.id)
-        user_stats.setdefault(user_id, {}).setdefault(chat_id, {
-            'join_date': datetime.datetime.now().isoformat(),
-            'reactions_given': 0,
-            'quote_requests': 0
-        })['reactions_given'] += 1
-        save_data()
+        shown = call.message.reply_markup.to_json() if call.message.reply_markup else None
+        reaction_edits.request(key, share_query(call.message), shown=shown)
+        record_user_stat(user_id, chat_id, 'reactions_given')
         logger.info(f"Reaction processed successfully in chat {chat_id}")
     except Exception as e:
         logger.error(f"Reaction error in chat {chat_id}: {e}")
@@ -480,14 +1003,21 @@ def set_type(message):
     if not is_admin(chat_id, message.from_user.id):
         bot.reply_to(message, "❌ आपको यह कमांड इस्तेमाल करने के लिए एडमिन होना चाहिए।")
         return
-    args = message.text.split()
-    if len(args) != 2 or args[1].lower() not in ['text', 'img']:
-        bot.reply_to(message, "❌ सही उपयोग:\n/settype text\nया\n/settype img")
+    args = [arg.lower() for arg in message.text.split()]
+    templates = ", ".join(TEMPLATES)
+    if len(args) not in (2, 3) or args[1] not in ['text', 'img'] or (len(args) == 3 and args[1] != 'img'):
+        bot.reply_to(message, f"❌ सही उपयोग:\n/settype text\nया\n/settype img [template]\n\nटेम्पलेट: {templates}")
         return
-    chat_settings[chat_id] = args[1].lower()
-    save_data()
-    bot.reply_to(message, f"✅ सेटिंग सेव हो गई है: कोट्स अब <b>{args[1].lower()}</b> के रूप में भेजे जाएंगे।", parse_mode="HTML")
-    logger.info(f"Set type to {args[1].lower()} in chat {chat_id}")
+    send_type = args[1]
+    if len(args) == 3:
+        if args[2] not in TEMPLATES:
+            bot.reply_to(message, f"❌ अज्ञात टेम्पलेट। उपलब्ध: {templates}")
+            return
+        if args[2] != DEFAULT_TEMPLATE:
+            send_type = f"img:{args[2]}"
+    record_event(('setting', chat_id, send_type))
+    bot.reply_to(message, f"✅ सेटिंग सेव हो गई है: कोट्स अब <b>{send_type}</b> के रूप में भेजे जाएंगे।", parse_mode="HTML")
+    logger.info(f"Set type to {send_type} in chat {chat_id}")
 
 # Set Quote Time Command
 @bot.message_handler(commands=['setquotetime'])
@@ -556,8 +1086,8 @@ def handle_set_interval(call):
         _, interval_str, chat_id_str = call.data.split(':')
         chat_id = int(chat_id_str)
         interval = int(interval_str)
-        chat_schedules[chat_id] = interval
-        last_quote_times[chat_id] = 0
+        record_event(('interval', chat_id, interval))
+        schedule_chat(chat_id)
         unit = "मिनट" if interval <= 3600 else "घंटे"
         value = interval // 60 if unit == "मिनट" else interval // 3600
         bot.edit_message_text(
@@ -632,7 +1162,6 @@ def profile_command(message):
 # Quotes Command
 @bot.message_handler(commands=['quotes'])
 def generate_quote(message):
-    global total_quote_count
     chat_id = message.chat.id
     user_id = message.from_user.id
     logger.info(f"Processing /quotes command in chat {chat_id}")
@@ -643,8 +1172,7 @@ def generate_quote(message):
             logger.error("Main event loop not initialized")
             bot.reply_to(message, "⚠️ Bot initialization error. Please try again later.")
             return
-        future = asyncio.run_coroutine_threadsafe(get_hindi_quote(), main_loop)
-        quote = future.result(timeout=10)  # 10-second timeout
+        quote = take_quotes(1, chat_id)[0]  # live fetch has a 10-second timeout
         if not quote:
             bot.reply_to(message, "⚠️ कोट प्राप्त करने में त्रुटि। कृपया बाद में पुनः प्रयास करें।")
             logger.error("Failed to fetch quote")
@@ -657,40 +1185,23 @@ def generate_quote(message):
     try:
         if message.chat.type in ['group', 'supergroup']:
             send_type = chat_settings.get(chat_id, 'text')
+            markup = create_reaction_buttons(chat_id, quote=quote)
             if send_type == 'text':
-                msg = bot.send_message(chat_id, f"🧠💖 कोट:\n\n{quote}", parse_mode="HTML")
-                markup = create_reaction_buttons(chat_id, msg.message_id)
-                bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
+                bot.send_message(chat_id, f"🧠💖 कोट:\n\n{quote}", parse_mode="HTML", reply_markup=markup)
             else:
-                img = generate_quote_image(quote)
+                img = generate_quote_image(quote, chat_template(chat_id))
                 if img:
-                    msg = bot.send_photo(chat_id, img, caption="🧠 कोट")
-                    markup = create_reaction_buttons(chat_id, msg.message_id)
-                    bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
+                    bot.send_photo(chat_id, img, caption="🧠 कोट", reply_markup=markup)
                 else:
-                    msg = bot.send_message(chat_id, f"🧠 कोट:\n\n{quote}", parse_mode="HTML")
-                    markup = create_reaction_buttons(chat_id, msg.message_id)
-                    bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
-            with total_quote_count_lock:
-                quote_counts[chat_id] = quote_counts.get(chat_id, 0) + 1
-                total_quote_count += 1
-            user_stats.setdefault(user_id, {}).setdefault(chat_id, {
-                'join_date': datetime.datetime.now().isoformat(),
-                'reactions_given': 0,
-                'quote_requests': 0
-            })['quote_requests'] += 1
-            save_data()
+                    bot.send_message(chat_id, f"🧠 कोट:\n\n{quote}", parse_mode="HTML", reply_markup=markup)
+            record_event(('quote', chat_id))
+            record_user_stat(user_id, chat_id, 'quote_requests')
         else:
-            msg = bot.send_message(chat_id, f"🧠💖 कोट:\n\n{quote}", parse_mode="HTML")
-            markup = create_reaction_buttons(chat_id, msg.message_id)
-            bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
-            user_stats.setdefault(user_id, {}).setdefault(chat_id, {
-                'join_date': datetime.datetime.now().isoformat(),
-                'reactions_given': 0,
-                'quote_requests': 0
-            })['quote_requests'] += 1
-            save_data()
+            markup = create_reaction_buttons(chat_id, quote=quote)
+            bot.send_message(chat_id, f"🧠💖 कोट:\n\n{quote}", parse_mode="HTML", reply_markup=markup)
+            record_user_stat(user_id, chat_id, 'quote_requests')
         latest_quotes[chat_id] = quote
+        mark_seen(chat_id, quote)
         logger.info(f"Quote sent successfully in chat {chat_id}")
     except Exception as e:
         logger.error(f"Quote send error in chat {chat_id}: {e}")
@@ -751,10 +1262,7 @@ def poll_quote(message):
             logger.error("Main event loop not initialized")
             bot.reply_to(message, "⚠️ Bot initialization error. Please try again later.")
             return
-        future1 = asyncio.run_coroutine_threadsafe(get_hindi_quote(), main_loop)
-        future2 = asyncio.run_coroutine_threadsafe(get_hindi_quote(), main_loop)
-        quote1 = future1.result(timeout=10)
-        quote2 = future2.result(timeout=10)
+        quote1, quote2 = take_quotes(2, chat_id)
         if not quote1 or not quote2:
             bot.reply_to(message, "⚠️ कोट प्राप्त करने में त्रुटि। कृपया बाद में पुनः प्रयास करें।")
             logger.error("Failed to fetch quotes for poll")
@@ -772,117 +1280,361 @@ def poll_quote(message):
         bot.reply_to(message, "⚠️ Error creating quote poll.")
 
 # Quote Scheduler
-async def send_quote_to_all():
-    global total_quote_count
-    logger.info("Running quote scheduler...")
-    quote = await get_hindi_quote()
+# Broadcast deliveries run concurrently on the async Bot API client; the engine
+# keeps them under Telegram's rate limits
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY") or 16)
+BROADCAST_GLOBAL_RATE = 25  # API calls per second across all chats
+BROADCAST_CHAT_RATE = 20 / 60  # per group
+
+broadcaster = BroadcastEngine(telegram_retry_after, concurrency=BROADCAST_CONCURRENCY,
+                              global_rate=BROADCAST_GLOBAL_RATE, chat_rate=BROADCAST_CHAT_RATE,
+                              permanent_error=telegram_permanent_error)
+
+# Image chats in one tick mostly get the same quote: the first chat renders and
+# uploads it while the others wait, then everyone gets the returned file_id.
+# If Telegram rejects the file_id itself, the bytes are uploaded again.
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired",
+                  "file_reference_expired", "failed to get http url content", "media_empty")
+
+def is_file_id_error(e):
+    if getattr(e, 'error_code', None) != 400:
+        return False
+    description = str(getattr(e, 'description', e)).lower()
+    return any(marker in description for marker in FILE_ID_ERRORS)
+
+async def send_broadcast_photo(chat_id, quote, markup, uploaded, upload_locks):
+    key = (quote, chat_template(chat_id))
+    async with upload_locks.setdefault(key, asyncio.Lock()):
+        file_id = uploaded.get(key)
+        if not file_id:
+            img = await generate_quote_image_async(*key)
+            if not img:
+                return None
+            msg = await bot_api.send_photo(chat_id, img, caption="🧠 आज का विचार", reply_markup=markup)
+            if msg.photo:
+                uploaded[key] = msg.photo[-1].file_id
+            return msg
+    try:
+        return await bot_api.send_photo(chat_id, file_id, caption="🧠 आज का विचार", reply_markup=markup)
+    except Exception as e:
+        # Anything else (blocked, kicked, chat not found, ...) would fail the upload just the same
+        if not is_file_id_error(e):
+            raise
+        logger.warning(f"Cached file_id send failed in chat {chat_id}, re-uploading: {e}")
+    img = await generate_quote_image_async(*key)
+    if not img:
+        return None
+    return await bot_api.send_photo(chat_id, img, caption="🧠 आज का विचार", reply_markup=markup)
+
+# Chats are kept in a heap by next due time; the scheduler sleeps until the
+# earliest one and only fetches a quote when something is actually due.
+DEFAULT_INTERVAL = 24*3600
+SEND_RETRY_SECONDS = 60
+CATCHUP_WINDOW_SECONDS = int(os.getenv("CATCHUP_WINDOW_SECONDS") or 1800)
+due_chats = DueScheduler()
+
+def schedule_chat(chat_id):
+    if chat_id not in subscribed_chats:
+        return
+    if leases is not None and not leases.owns_chat(chat_id):
+        return
+    interval = chat_schedules.get(chat_id, DEFAULT_INTERVAL)
+    due_chats.set(chat_id, last_quote_times.get(chat_id, 0) + interval)
+
+# After a deploy or /reboot many chats are overdue at once. Instead of sending to
+# all of them in the first tick, each gets a random slot in the catch-up window,
+# never later than one of its own intervals from now.
+def schedule_catch_up(chat_ids):
+    now = time.time()
+    overdue = 0
+    chat_ids = [chat_id for chat_id in chat_ids if chat_id in subscribed_chats]
+    for chat_id in chat_ids:
+        interval = chat_schedules.get(chat_id, DEFAULT_INTERVAL)
+        due = last_quote_times.get(chat_id, 0) + interval
+        if due <= now:
+            due = now + random.uniform(0, min(CATCHUP_WINDOW_SECONDS, interval))
+            overdue += 1
+        due_chats.set(chat_id, due)
+    logger.info(f"Scheduled {len(chat_ids)} chats, {overdue} overdue spread over catch-up window")
+
+# A chat rescheduled while its send was in flight (e.g. a new interval) keeps the earlier time
+def retry_chats(chat_ids, delay=SEND_RETRY_SECONDS):
+    retry_at = time.time() + delay
+    for chat_id in chat_ids:
+        if chat_id not in subscribed_chats:
+            continue
+        due = due_chats.due_at(chat_id)
+        if due is None or due > retry_at:
+            due_chats.set(chat_id, retry_at)
+
+# Unreachable chats (blocked, kicked, deleted) wait a full interval instead of retrying every minute
+def defer_chats(chat_ids):
+    for chat_id in chat_ids:
+        retry_chats([chat_id], chat_schedules.get(chat_id, DEFAULT_INTERVAL))
+
+async def send_quote_to_all(chat_ids):
+    logger.info(f"Running quote scheduler for {len(chat_ids)} due chats...")
+    quote = await next_quote()
     if not quote:
         logger.error("Quote fetch failed in scheduler")
+        retry_chats(chat_ids)
         return
     current_time = time.time()
-    for chat_id in list(subscribed_chats):
-        interval = chat_schedules.get(chat_id, 24*3600)
-        last_sent = last_quote_times.get(chat_id, 0)
-        if current_time - last_sent < interval:
-            continue
-        try:
-            send_type = chat_settings.get(chat_id, 'text')
-            if send_type == 'text':
-                msg = bot.send_message(chat_id, f"🧠 <b>आज का विचार</b>:\n\n{quote}", parse_mode="HTML")
-                markup = create_reaction_buttons(chat_id, msg.message_id)
-                bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
-            else:
-                img = generate_quote_image(quote)
-                if img:
-                    msg = bot.send_photo(chat_id, img, caption="🧠 आज का विचार")
-                    markup = create_reaction_buttons(chat_id, msg.message_id)
-                    bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
+    uploaded = {}  # (quote, template) -> photo file_id for this tick
+    upload_locks = {}
+
+    async def deliver(chat_id):
+        if chat_id not in subscribed_chats:
+            return
+        if leases is not None:
+            status, last_sent = await lease_call(leases.claim_send, chat_id, current_time)
+            if status != 'claimed':
+                # Sent by another worker already, or the partition has moved on
+                if status == 'not_due':
+                    set_last_sent(chat_id, last_sent)
+                    schedule_chat(chat_id)
                 else:
-                    msg = bot.send_message(chat_id, f"🧠 <b>आज का विचार</b>:\n\n{quote}", parse_mode="HTML")
-                    markup = create_reaction_buttons(chat_id, msg.message_id)
-                    bot.edit_message_reply_markup(chat_id, msg.message_id, reply_markup=markup)
-            last_quote_times[chat_id] = current_time
-            latest_quotes[chat_id] = quote
-            with total_quote_count_lock:
-                quote_counts[chat_id] = quote_counts.get(chat_id, 0) + 1
-                total_quote_count += 1
-            save_data()
-            logger.info(f"Scheduled quote sent to chat {chat_id}")
-        except Exception as e:
-            logger.error(f"Send error in chat {chat_id}: {e}")
+                    due_chats.remove(chat_id)
+                return
+        # The shared quote is only used where it is not a recent repeat
+        chat_quote = quote
+        if is_seen(chat_id, quote):
+            chat_quote = await next_quote(chat_id) or quote
+        markup = create_reaction_buttons(chat_id, quote=chat_quote)
+        try:
+            msg = None
+            if chat_settings.get(chat_id, 'text') != 'text':
+                msg = await send_broadcast_photo(chat_id, chat_quote, markup, uploaded, upload_locks)
+            if msg is None:
+                await bot_api.send_message(chat_id, f"🧠 <b>आज का विचार</b>:\n\n{chat_quote}", parse_mode="HTML",
+                                           reply_markup=markup)
+        except Exception:
+            if leases is not None:
+                # Unclaim, so the retry finds the chat due again
+                await lease_call(leases.release_send, chat_id, last_sent, current_time)
+            raise
+        if leases is not None:
+            await lease_call(leases.finish_send, chat_id, current_time, chat_quote)
+        mark_seen(chat_id, chat_quote)
+        set_last_sent(chat_id, current_time)
+        if not broadcast_worker:
+            latest_quotes[chat_id] = chat_quote
+            record_event(('quote', chat_id))
+        schedule_chat(chat_id)
+        logger.info(f"Scheduled quote sent to chat {chat_id}")
+
+    report = await broadcaster.run(chat_ids, deliver, label=time.strftime("%H:%M:%S"))
+    retry_chats(report.failed_chats)
+    defer_chats(report.permanent_chats)
 
 async def scheduler():
     logger.info("Starting scheduler...")
+    due_chats.bind(asyncio.get_running_loop())
+    if leases is not None:
+        asyncio.get_running_loop().create_task(lease_keeper())
+    else:
+        schedule_catch_up(list(subscribed_chats))
+    while True:
+        await due_chats.wait()
+        chat_ids = due_chats.pop_due()
+        if chat_ids:
+            await send_quote_to_all(chat_ids)
+
+# Broadcast Workers
+# With BROADCAST_LEASE_DB set, scheduled sends are split by chat between this
+# process and any `python main.py broadcast-worker` processes on the same host,
+# through leases in a shared SQLite file (see leases.py). The bot process stays
+# the only writer of bot state: it publishes chat schedules to the lease table
+# and records the workers' sends as its own events.
+BROADCAST_LEASE_DB = os.getenv("BROADCAST_LEASE_DB")
+BROADCAST_PARTITIONS = int(os.getenv("BROADCAST_PARTITIONS") or 64)
+LEASE_TTL_SECONDS = 30
+LEASE_EVENTS = ('subscription', 'interval', 'setting', 'forget_chat')
+leases = None
+# Lease transactions can wait on other workers' locks; they run on this thread, never on the event loop
+lease_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leases")
+lease_version = 0  # last lease table change applied here
+broadcast_worker = False  # True in a broadcast-worker process, which owns no bot state
+
+def open_leases():
+    global leases
+    if BROADCAST_LEASE_DB and leases is None:
+        leases = LeaseTable(BROADCAST_LEASE_DB, os.getenv("BROADCAST_WORKER_ID"), partitions=BROADCAST_PARTITIONS,
+                            ttl=LEASE_TTL_SECONDS, default_interval=DEFAULT_INTERVAL)
+    return leases
+
+async def lease_call(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(lease_executor, fn, *args)
+
+def publish_schedules(chat_ids, reset=False):
+    try:
+        leases.publish([(chat_id, chat_id in subscribed_chats, chat_schedules.get(chat_id), chat_settings.get(chat_id),
+                         last_quote_times.get(chat_id, 0)) for chat_id in chat_ids], reset_last_sent=reset)
+    except Exception as e:
+        logger.error(f"Lease publish error: {e}")
+
+def set_last_sent(chat_id, sent_at):
+    if broadcast_worker:
+        last_quote_times[chat_id] = sent_at
+    elif sent_at != last_quote_times.get(chat_id):
+        record_event(('sent', chat_id, sent_at))
+
+def apply_lease_row(row):
+    chat_id = row.chat_id
+    if broadcast_worker:
+        # Workers keep a copy of just the chats they send to
+        if row.subscribed:
+            subscribed_chats.add(chat_id)
+        else:
+            subscribed_chats.discard(chat_id)
+        if row.interval:
+            chat_schedules[chat_id] = row.interval
+        else:
+            chat_schedules.pop(chat_id, None)
+        if row.send_type:
+            chat_settings[chat_id] = row.send_type
+        last_quote_times[chat_id] = row.last_sent
+    elif row.sent_by not in (None, leases.worker_id) and row.last_sent > last_quote_times.get(chat_id, 0):
+        record_event(('sent', chat_id, row.last_sent))
+        if row.last_quote:
+            latest_quotes[chat_id] = row.last_quote
+            record_event(('quote', chat_id))
+
+async def sync_leases():
+    global lease_version
+    gained, lost = await lease_call(leases.heartbeat)
+    changed = await lease_call(leases.changes, lease_version)
+    if changed:
+        lease_version = changed[-1].version
+    for row in changed:
+        apply_lease_row(row)
+        if not leases.owns_chat(row.chat_id):
+            continue
+        if row.subscribed:
+            schedule_chat(row.chat_id)
+        else:
+            due_chats.remove(row.chat_id)
+    for row in await lease_call(leases.chats_in, lost):
+        due_chats.remove(row.chat_id)
+        if broadcast_worker:
+            subscribed_chats.discard(row.chat_id)
+    if gained:
+        rows = await lease_call(leases.chats_in, gained)
+        for row in rows:
+            apply_lease_row(row)
+        schedule_catch_up([row.chat_id for row in rows])
+
+async def lease_keeper():
+    global lease_version
+    logger.info(f"Starting lease keeper as {leases.worker_id}...")
+    if broadcast_worker:
+        # Partitions gained on the first heartbeat are loaded in full anyway
+        lease_version = await lease_call(leases.version)
+    else:
+        await lease_call(publish_schedules, set(subscribed_chats) | set(chat_schedules) | set(chat_settings))
     while True:
-        await send_quote_to_all()
-        await asyncio.sleep(60)
+        try:
+            await sync_leases()
+        except Exception as e:
+            logger.error(f"Lease sync error: {e}")
+        await asyncio.sleep(LEASE_TTL_SECONDS / 3)
+
+def release_leases():
+    if leases is not None:
+        try:
+            leases.release()
+        except Exception as e:
+            logger.error(f"Lease release error: {e}")
+
+async def broadcast_worker_main():
+    global main_loop
+    main_loop = asyncio.get_running_loop()
+    main_loop.create_task(quote_pool.run())
+    try:
+        await scheduler()
+    finally:
+        await lease_call(release_leases)
+        await close_http_session()
+
+# Entry point for `python main.py broadcast-worker`
+def run_broadcast_worker():
+    global broadcast_worker, SEEN_FILE
+    if not BROADCAST_LEASE_DB:
+        logger.error("broadcast-worker needs BROADCAST_LEASE_DB")
+        return 1
+    if not os.getenv("BROADCAST_WORKER_ID"):
+        # The id names this worker's seen-quotes file, so it has to survive restarts
+        logger.error("broadcast-worker needs a stable BROADCAST_WORKER_ID")
+        return 1
+    broadcast_worker = True
+    atexit.unregister(flush_data)  # nothing to flush, and bot_data.json belongs to the bot process
+    start_render_service()
+    open_leases()
+    # The seen-quotes rings are a single-writer file; each worker keeps its own, named by its id
+    SEEN_FILE = f"{SEEN_FILE}.{leases.worker_id}"
+    try:
+        asyncio.run(broadcast_worker_main())
+    except KeyboardInterrupt:
+        logger.info("Broadcast worker stopped")
+    finally:
+        render_service.stop()
+    return 0
 
 # Leaderboard Logic
 def update_leaderboard(chat_id, user_id, user_name):
-    if chat_id not in leaderboard_data:
-        leaderboard_data[chat_id] = {}
-    if user_id not in leaderboard_data[chat_id]:
-        leaderboard_data[chat_id][user_id] = {
-            "name": user_name,
-            "daily": {},
-            "weekly": {},
-            "overall": 0
-        }
-    
-    user_data = leaderboard_data[chat_id][user_id]
-    user_data["name"] = user_name
-    user_data["overall"] += 1
-    
     today_key = time.strftime("%Y-%m-%d")
     week_key = time.strftime("%Y-W%U")
-    
-    user_data["daily"][today_key] = user_data["daily"].get(today_key, 0) + 1
-    user_data["weekly"][week_key] = user_data["weekly"].get(week_key, 0) + 1
-    save_data()
+    record_event(('message', chat_id, user_id, user_name, today_key, week_key))
 
 def clean_leaderboard_data():
     logger.info("Starting leaderboard cleanup...")
     while True:
         current_date = time.strftime("%Y-%m-%d")
         current_week = time.strftime("%Y-W%U")
-        for chat_id in leaderboard_data:
-            for user_id in leaderboard_data[chat_id]:
-                data = leaderboard_data[chat_id][user_id]
-                data["daily"] = {k: v for k, v in data["daily"].items() if k >= current_date}
-                data["weekly"] = {k: v for k, v in data["weekly"].items() if k >= current_week}
-        save_data()
+        record_event(('prune', current_date, current_week))
         logger.info("Leaderboard cleanup completed")
         time.sleep(24*3600)
 
+def leaderboard_rows(chat_id, mode, limit=10):
+    today_key = time.strftime("%Y-%m-%d")
+    week_key = time.strftime("%Y-W%U")
+    if store is not None:
+        bucket = today_key if mode == "daily" else week_key
+        return store.top_users(chat_id, mode if mode in ("daily", "weekly") else "overall", bucket, limit)
+    leaderboard = []
+    with data_lock:
+        for user_id, data in leaderboard_data.get(chat_id, {}).items():
+            if mode == "daily":
+                count = data["daily"].get(today_key, 0)
+            elif mode == "weekly":
+                count = data["weekly"].get(week_key, 0)
+            else:
+                count = data["overall"]
+            if count > 0:
+                leaderboard.append((data["name"], count))
+    leaderboard.sort(key=lambda x: x[1], reverse=True)
+    return leaderboard[:limit]
+
+def leaderboard_user_count(chat_id):
+    if store is not None:
+        return store.user_count(chat_id)
+    with data_lock:
+        return len(leaderboard_data.get(chat_id, {}))
+
 async def display_leaderboard(chat_id, mode="overall"):
     logger.info(f"Displaying leaderboard for chat {chat_id}, mode: {mode}")
-    if chat_id not in leaderboard_data or not leaderboard_data[chat_id]:
+    user_count = leaderboard_user_count(chat_id)
+    if not user_count:
         return "📊 <b>लीडरबोर्ड</b>\n\n<i>कोई संदेश अभी तक नहीं!</i>", None
 
-    leaderboard = []
-    today_key = time.strftime("%Y-%m-%d")
-    week_key = time.strftime("%Y-W%U")
-    
+    leaderboard = leaderboard_rows(chat_id, mode)
     if mode == "daily":
-        for user_id, data in leaderboard_data[chat_id].items():
-            count = data["daily"].get(today_key, 0)
-            if count > 0:
-                leaderboard.append((data["name"], count))
         caption = "📅 <b>दैनिक लीडरबोर्ड</b>\n\n"
     elif mode == "weekly":
-        for user_id, data in leaderboard_data[chat_id].items():
-            count = data["weekly"].get(week_key, 0)
-            if count > 0:
-                leaderboard.append((data["name"], count))
         caption = "📈 <b>साप्ताहिक लीडरबोर्ड</b>\n\n"
     else:
-        for user_id, data in leaderboard_data[chat_id].items():
-            count = data["overall"]
-            if count > 0:
-                leaderboard.append((data["name"], count))
         caption = "🏆 <b>कुल लीडरबोर्ड</b>\n\n"
 
-    leaderboard.sort(key=lambda x: x[1], reverse=True)
     for i, (name, count) in enumerate(leaderboard[:10], 1):
         rank = "🏅" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else ""
         caption += f"{i}. {name} — {count} संदेश {rank}\n"
@@ -890,7 +1642,7 @@ async def display_leaderboard(chat_id, mode="overall"):
     if not leaderboard:
         caption += "<i>कोई संदेश अभी तक नहीं!</i>"
     
-    caption += f"\n🧮 <b>कुल उपयोगकर्ता</b>: {len(leaderboard_data.get(chat_id, {}))}"
+    caption += f"\n🧮 <b>कुल उपयोगकर्ता</b>: {user_count}"
     logger.info(f"Leaderboard generated for chat {chat_id}")
     return caption, InlineKeyboardMarkup([
         [
@@ -939,7 +1691,12 @@ async def reboot_handler(client, message):
         await message.reply_text("🔄 Rebooting...")
         await client.stop()
         logger.info("Shutting down for reboot")
-        os.execv(sys.executable, ['python3'] + sys.argv[1:])
+        release_leases()
+        persistence.stop()  # os.execv skips atexit handlers
+        flush_data()
+        render_service.stop()
+        await close_http_session()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
     except Exception as e:
         logger.error(f"Reboot error: {e}")
         await message.reply_text(f"⚠️ Reboot failed: {e}")
@@ -968,10 +1725,10 @@ def new_member_handler(message):
         for member in message.new_chat_members:
             chat_id = message.chat.id
             if member.id == bot.get_me().id:
-                subscribed_chats.add(chat_id)
+                record_event(('subscription', chat_id, True))
+                schedule_chat(chat_id)
                 if chat_id not in chat_settings:
-                    chat_settings[chat_id] = 'text'
-                save_data()
+                    record_event(('setting', chat_id, 'text'))
                 bot.send_message(chat_id, "<b>धन्यवाद!</b> मैं इस ग्रुप में जुड़ गया हूँ और अब से दैनिक कोट्स भेजूंगा।", parse_mode="HTML")
                 logger.info(f"Bot joined chat {chat_id}")
             else:
@@ -989,12 +1746,7 @@ def new_member_handler(message):
                 bot.send_message(chat_id, full_message, parse_mode="HTML")
                 logger.info(f"Welcomed user {member.id} in chat {chat_id}")
                 if member.id != bot.get_me().id:
-                    user_stats.setdefault(member.id, {}).setdefault(chat_id, {
-                        'join_date': datetime.datetime.now().isoformat(),
-                        'reactions_given': 0,
-                        'quote_requests': 0
-                    })
-                    save_data()
+                    record_user_stat(member.id, chat_id)
     except Exception as e:
         logger.error(f"New member handler error in chat {chat_id}: {e}")
         # Fallback: send plain text without mention if HTML fails
@@ -1012,11 +1764,8 @@ def left_member_handler(message):
     logger.info(f"Processing left member event in chat {chat_id}")
     try:
         if message.left_chat_member.id == bot.get_me().id:
-            subscribed_chats.discard(chat_id)
-            for data in [leaderboard_data, latest_quotes, quote_counts, start_message_ids, help_message_ids]:
-                if chat_id in data:
-                    del data[chat_id]
-            save_data()
+            due_chats.remove(chat_id)
+            record_event(('forget_chat', chat_id))
             logger.info(f"Bot left chat {chat_id}")
     except Exception as e:
         logger.error(f"Left member handler error in chat {chat_id}: {e}")
@@ -1034,12 +1783,37 @@ def webhook():
         logger.error(f"Webhook processing error: {e}")
         return 'Internal Server Error', 500
 
+# Monitoring endpoint
+def collect_stats():
+    return {
+        'quote_api': quote_fetcher.stats(),
+        'quote_pool': quote_pool.stats(),
+        'image_cache': image_cache.stats(),
+        'render_service': render_service.stats(),
+        'scheduler': due_chats.stats(),
+        'broadcast': broadcaster.stats(),
+        'bot_api': bot_api.stats(),
+        'reaction_edits': reaction_edits.stats(),
+        'leases': leases.stats() if leases is not None else None,
+        'shards': shards.stats() if shards is not None else None,
+        'quote_corpus': {'size': len(quote_corpus) if quote_corpus is not None else 0},
+        'seen_quotes': seen_quotes.stats() if seen_quotes is not None else None
+    }
+
+@flask_app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    return flask_app.response_class(json.dumps(collect_stats()), mimetype='application/json')
+
 # Start Bot with Webhook
 async def main():
     global main_loop
     logger.info("Starting bot with webhook...")
     try:
+        start_render_service()
         load_data()
+        open_leases()
+        persistence.start()
+        card_renderer.warm()
         main_loop = asyncio.get_event_loop()
         logger.info("Main event loop initialized")
         await app.start()
@@ -1047,31 +1821,62 @@ async def main():
 
         # Set webhook
         webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/{TOKEN}"
-        await bot.set_webhook(url=webhook_url)
+        await bot_api.set_webhook(webhook_url)
         logger.info(f"Webhook set to {webhook_url}")
 
         loop = asyncio.get_event_loop()
         loop.create_task(scheduler())
+        loop.create_task(quote_pool.run())
         threading.Thread(target=clean_leaderboard_data, daemon=True).start()
+        threading.Thread(target=journal_compactor, daemon=True).start()
 
         logger.info("Bot is fully running with webhook")
         # Flask app will run in the main thread (see below)
     except Exception as e:
         logger.error(f"Main loop error: {e}")
-    finally:
-        # Ensure cleanup on shutdown
-        await app.stop()
-        await bot.delete_webhook()
-        logger.info("Bot stopped and webhook deleted")
 
-if __name__ == "__main__":
+# Runs on the event loop once Flask has returned
+async def shutdown():
+    for step in (app.stop, bot_api.delete_webhook, close_http_session):
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"Shutdown error in {step.__name__}: {e}")
+    logger.info("Bot stopped and webhook deleted")
+
+def run(argv):
+    if argv[:1] == ["broadcast-worker"]:
+        return run_broadcast_worker()
+    # The event loop lives on its own thread for the whole process, so the scheduler,
+    # the quote pool and the shared HTTP session keep running while Flask serves
+    # webhooks. It is the loop the Pyrogram client was built with.
+    loop = app.loop
+    loop_thread = threading.Thread(target=loop.run_forever, name="EventLoop", daemon=True)
+    loop_thread.start()
     try:
         # Start the bot with webhook
-        asyncio.run(main())
+        asyncio.run_coroutine_threadsafe(main(), loop).result()
         # Run Flask app to handle webhook requests
         port = int(os.getenv("PORT", 5000))
         flask_app.run(host="0.0.0.0", port=port)
     except KeyboardInterrupt:
         logger.info("Received shutdown signal")
     except Exception as e:
-        logger.error(f"Startup error: {e}")
\ No newline at end of file
+        logger.error(f"Startup error: {e}")
+    finally:
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=30)
+        except Exception as e:
+            logger.error(f"Shutdown error: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join(timeout=5)
+        release_leases()
+        persistence.stop()
+        render_service.stop()
+        logger.info("Pending data flushed")
+    return 0
+
+if __name__ == "__main__":
+    # Render workers would re-run this whole module; start through main.py instead
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")]
+             + sys.argv[1:])
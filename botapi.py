@@ -0,0 +1,167 @@
+import json
+import logging
+from io import BytesIO
+
+import aiohttp
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+BOT_API_URL = "https://api.telegram.org"
+BOT_API_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+UPLOAD_TIMEOUT = aiohttp.ClientTimeout(total=90, connect=5)
+
+
+# Same attribute names as telebot's ApiTelegramException, so error handling
+# (e.g. reading retry_after) works for both clients
+class BotAPIError(Exception):
+    def __init__(self, method, result_json):
+        self.method = method
+        self.result_json = result_json
+        self.error_code = result_json.get('error_code')
+        self.description = result_json.get('description', '')
+        super().__init__(f"{method} failed: [{self.error_code}] {self.description}")
+
+    @property
+    def retry_after(self):
+        return (self.result_json.get('parameters') or {}).get('retry_after')
+
+
+def _photo_filename(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "quote.png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "quote.webp"
+    return "quote.jpg"
+
+
+# telebot markup/media objects serialize to JSON strings; send them as objects
+def _json_object(value):
+    if value is None:
+        return None
+    if hasattr(value, 'to_json'):
+        value = value.to_json()
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def _message(result):
+    return types.Message.de_json(result) if isinstance(result, dict) else result
+
+
+# Minimal asyncio Bot API client for code running on the event loop. It uses the
+# bot's shared aiohttp session (get_session is a coroutine returning it), so
+# Telegram calls and quote fetches share one keep-alive connection pool.
+# Results come back as telebot types so callers can treat both clients alike.
+class AsyncBotAPI:
+    def __init__(self, token, get_session, base_url=BOT_API_URL):
+        self.url = f"{base_url}/bot{token}/"
+        self.get_session = get_session
+        self.calls = 0
+        self.errors = 0
+
+    async def call(self, method, params=None, files=None):
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        session = await self.get_session()
+        self.calls += 1
+        if files:
+            data = aiohttp.FormData()
+            for key, value in params.items():
+                data.add_field(key, value if isinstance(value, str) else json.dumps(value))
+            for key, (filename, content) in files.items():
+                data.add_field(key, content, filename=filename)
+            request = session.post(self.url + method, data=data, timeout=UPLOAD_TIMEOUT)
+        else:
+            request = session.post(self.url + method, json=params, timeout=BOT_API_TIMEOUT)
+        async with request as res:
+            try:
+                payload = await res.json(content_type=None)
+            except ValueError:
+                self.errors += 1
+                raise BotAPIError(method, {'error_code': res.status, 'description': await res.text()})
+        if not payload.get('ok'):
+            self.errors += 1
+            raise BotAPIError(method, payload)
+        return payload.get('result')
+
+    async def get_me(self):
+        return types.User.de_json(await self.call("getMe"))
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None, reply_to_message_id=None,
+                           disable_web_page_preview=None):
+        return _message(await self.call("sendMessage", {
+            'chat_id': chat_id, 'text': text, 'parse_mode': parse_mode, 'reply_markup': _json_object(reply_markup),
+            'reply_to_message_id': reply_to_message_id, 'disable_web_page_preview': disable_web_page_preview
+        }))
+
+    # photo is a file_id/URL string, raw bytes or a file-like object
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, reply_markup=None,
+                         reply_to_message_id=None):
+        params = {
+            'chat_id': chat_id, 'caption': caption, 'parse_mode': parse_mode,
+            'reply_markup': _json_object(reply_markup), 'reply_to_message_id': reply_to_message_id
+        }
+        if isinstance(photo, str):
+            params['photo'] = photo
+            return _message(await self.call("sendPhoto", params))
+        data = photo.getvalue() if isinstance(photo, BytesIO) else photo if isinstance(photo, bytes) else photo.read()
+        return _message(await self.call("sendPhoto", params, files={'photo': (_photo_filename(data), data)}))
+
+    async def send_poll(self, chat_id, question, options, is_anonymous=None, type=None, allows_multiple_answers=None,
+                        correct_option_id=None, explanation=None, open_period=None, reply_markup=None):
+        return _message(await self.call("sendPoll", {
+            'chat_id': chat_id, 'question': question, 'options': list(options), 'is_anonymous': is_anonymous,
+            'type': type, 'allows_multiple_answers': allows_multiple_answers,
+            'correct_option_id': correct_option_id, 'explanation': explanation, 'open_period': open_period,
+            'reply_markup': _json_object(reply_markup)
+        }))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None,
+                                parse_mode=None, reply_markup=None, disable_web_page_preview=None):
+        return _message(await self.call("editMessageText", {
+            'chat_id': chat_id, 'message_id': message_id, 'inline_message_id': inline_message_id, 'text': text,
+            'parse_mode': parse_mode, 'reply_markup': _json_object(reply_markup),
+            'disable_web_page_preview': disable_web_page_preview
+        }))
+
+    async def edit_message_caption(self, caption, chat_id=None, message_id=None, inline_message_id=None,
+                                   parse_mode=None, reply_markup=None):
+        return _message(await self.call("editMessageCaption", {
+            'chat_id': chat_id, 'message_id': message_id, 'inline_message_id': inline_message_id,
+            'caption': caption, 'parse_mode': parse_mode, 'reply_markup': _json_object(reply_markup)
+        }))
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None,
+                                        reply_markup=None):
+        return _message(await self.call("editMessageReplyMarkup", {
+            'chat_id': chat_id, 'message_id': message_id, 'inline_message_id': inline_message_id,
+            'reply_markup': _json_object(reply_markup)
+        }))
+
+    # media is an InputMediaPhoto whose media is a file_id or URL
+    async def edit_message_media(self, media, chat_id=None, message_id=None, inline_message_id=None,
+                                 reply_markup=None):
+        return _message(await self.call("editMessageMedia", {
+            'chat_id': chat_id, 'message_id': message_id, 'inline_message_id': inline_message_id,
+            'media': _json_object(media), 'reply_markup': _json_object(reply_markup)
+        }))
+
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=None, url=None, cache_time=None):
+        return await self.call("answerCallbackQuery", {
+            'callback_query_id': callback_query_id, 'text': text, 'show_alert': show_alert, 'url': url,
+            'cache_time': cache_time
+        })
+
+    async def get_chat(self, chat_id):
+        return types.Chat.de_json(await self.call("getChat", {'chat_id': chat_id}))
+
+    async def get_chat_member(self, chat_id, user_id):
+        return types.ChatMember.de_json(await self.call("getChatMember", {'chat_id': chat_id, 'user_id': user_id}))
+
+    async def set_webhook(self, url, drop_pending_updates=None):
+        return await self.call("setWebhook", {'url': url, 'drop_pending_updates': drop_pending_updates})
+
+    async def delete_webhook(self, drop_pending_updates=None):
+        return await self.call("deleteWebhook", {'drop_pending_updates': drop_pending_updates})
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors}
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Classic token bucket for the event loop: rate tokens per second, up to capacity
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    # Seconds until n tokens are available (0 if they are now)
+    def delay(self, n=1):
+        self._refill()
+        paused = self.paused_until - self.updated
+        if paused > 0:
+            return paused
+        return 0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    # Hand out nothing for the next seconds (e.g. after a flood-wait)
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def take(self, n=1):
+        self.tokens -= n
+
+    async def acquire(self, n=1):
+        while True:
+            wait = self.delay(n)
+            if wait <= 0:
+                self.take(n)
+                return
+            await asyncio.sleep(wait)
+
+
+class BroadcastReport:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.failed_chats = []
+        self.permanent_chats = []  # failed with an error retrying cannot fix
+        self.started = time.monotonic()
+        self.finished = None
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+            'retries': self.retries,
+            'elapsed_s': round(self.elapsed(), 2),
+            'msgs_per_sec': round(self.throughput(), 2)
+        }
+
+
+# Fans one broadcast out over a fixed number of worker tasks. Every delivery
+# takes tokens from the global bucket and from its chat's bucket first. A 429
+# puts the chat back in the queue once retry_after has passed, without holding
+# a worker meanwhile; a 429 for a chat that had nothing sent recently can only
+# be the bot-wide limit, so it pauses the global bucket as well. Permanent
+# errors (see permanent_error) fail at once; others are retried with backoff
+# up to max_attempts, then reported as failed.
+class BroadcastEngine:
+    def __init__(self, retry_after, concurrency=16, global_rate=25, chat_rate=20 / 60, chat_burst=3,
+                 calls_per_send=1, max_attempts=3, progress_interval=10, permanent_error=None):
+        self.retry_after = retry_after
+        self.permanent_error = permanent_error
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.calls_per_send = calls_per_send
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.last_report = None
+        self.current = None
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Returns whether the chat's bucket was full, i.e. nothing went to it lately
+    async def _acquire(self, chat_id):
+        chat_bucket = self._chat_bucket(chat_id)
+        n = self.calls_per_send
+        # Take from both buckets at once so a chat waiting on its own limit holds no global tokens
+        while True:
+            wait = max(chat_bucket.delay(n), self.global_bucket.delay(n))
+            if wait <= 0:
+                idle = chat_bucket.tokens >= chat_bucket.capacity
+                chat_bucket.take(n)
+                self.global_bucket.take(n)
+                return idle
+            await asyncio.sleep(wait)
+
+    def _requeue(self, queue, timers, item, delay):
+        timers.append(asyncio.get_running_loop().call_later(delay, queue.put_nowait, item))
+
+    async def _worker(self, queue, timers, deliver, report, finished):
+        while True:
+            chat_id, attempt = await queue.get()
+            idle = await self._acquire(chat_id)
+            try:
+                await deliver(chat_id)
+                report.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retry_after = self.retry_after(e)
+                if retry_after is not None:
+                    report.rate_limited += 1
+                    report.retries += 1
+                    if idle:
+                        self.global_bucket.pause(retry_after)
+                        logger.warning(f"Broadcast rate limited bot-wide, pausing {retry_after}s")
+                    else:
+                        logger.warning(f"Broadcast to {chat_id} rate limited, retrying in {retry_after}s")
+                    self._requeue(queue, timers, (chat_id, attempt), retry_after)
+                    continue
+                permanent = self.permanent_error is not None and self.permanent_error(e)
+                if not permanent and attempt + 1 < self.max_attempts:
+                    report.retries += 1
+                    self._requeue(queue, timers, (chat_id, attempt + 1), 2 ** attempt)
+                    continue
+                report.failed += 1
+                (report.permanent_chats if permanent else report.failed_chats).append(chat_id)
+                logger.error(f"Broadcast to {chat_id} failed{' permanently' if permanent else ''}: {e}")
+            if report.sent + report.failed >= report.total:
+                finished.set()
+
+    async def _progress(self, report):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            done = report.sent + report.failed
+            logger.info(f"Broadcast {report.label}: {done}/{report.total} done, "
+                        f"{report.throughput():.1f} msg/s, {report.rate_limited} rate limited")
+
+    async def run(self, chat_ids, deliver, label="broadcast"):
+        report = self.current = BroadcastReport(label, len(chat_ids))
+        queue = asyncio.Queue()
+        timers = []  # retries wait here until due instead of in a worker
+        for chat_id in chat_ids:
+            queue.put_nowait((chat_id, 0))
+        finished = asyncio.Event()
+        if not chat_ids:
+            finished.set()
+        workers = [asyncio.create_task(self._worker(queue, timers, deliver, report, finished))
+                   for _ in range(min(self.concurrency, len(chat_ids)))]
+        progress = asyncio.create_task(self._progress(report))
+        try:
+            await finished.wait()
+        finally:
+            for timer in timers:
+                timer.cancel()
+            for task in workers + [progress]:
+                task.cancel()
+            await asyncio.gather(*workers, progress, return_exceptions=True)
+            report.finished = time.monotonic()
+            self.current = None
+            self.last_report = report
+            self._prune()
+        logger.info(f"Broadcast {label} finished: {report.sent} sent, {report.failed} failed "
+                    f"in {report.elapsed():.1f}s ({report.throughput():.1f} msg/s)")
+        return report
+
+    # Buckets that refilled completely carry no state worth keeping
+    def _prune(self):
+        for chat_id in [c for c, bucket in self._chat_buckets.items() if bucket.full()]:
+            del self._chat_buckets[chat_id]
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'global_rate': self.global_bucket.rate,
+            'chat_rate_per_min': round(self.chat_rate * 60, 1),
+            'running': self.current.as_dict() if self.current else None,
+            'last': self.last_report.as_dict() if self.last_report else None
+        }
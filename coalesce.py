@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Collapses bursts of updates to one message into a single edit. The first
+# request for a key opens a short window; requests inside it only replace the
+# context. When the window closes the current state is rendered once, and the
+# edit is skipped if it matches what the message already shows. Edits run on
+# one background thread, so edits to the same message never overtake each other.
+#
+#   render(key, context) -> payload (a string, e.g. markup JSON) or None to skip
+#   send(key, payload)   -> raises on failure
+#   retry_after(error)   -> seconds to back off for a rate-limit error, else None
+class EditCoalescer:
+    def __init__(self, render, send, window=1.0, retry_after=None, remember=10000):
+        self.render = render
+        self.send = send
+        self.window = window
+        self.retry_after = retry_after
+        self.remember = remember
+        self.requests = 0
+        self.coalesced = 0
+        self.edits = 0
+        self.skipped = 0
+        self.failed = 0
+        self._due = {}
+        self._context = {}
+        self._shown = OrderedDict()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="EditCoalescer", daemon=True)
+            self._thread.start()
+
+    # shown is what the message displays right now, if the caller knows it
+    def request(self, key, context=None, shown=None):
+        with self._cond:
+            self.requests += 1
+            self._context[key] = context
+            if shown is not None and key not in self._shown:
+                self._remember(key, shown)
+            if key in self._due:
+                self.coalesced += 1
+                return
+            self._due[key] = time.monotonic() + self.window
+            self._cond.notify()
+        if self._thread is None:
+            self.start()
+
+    def _remember(self, key, payload):
+        self._shown[key] = payload
+        self._shown.move_to_end(key)
+        while len(self._shown) > self.remember:
+            self._shown.popitem(last=False)
+
+    def _next_ready(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for key, due in self._due.items():
+                    if due <= now:
+                        del self._due[key]
+                        return key, self._context.pop(key, None)
+                self._cond.wait(min(self._due.values()) - now if self._due else None)
+
+    def _run(self):
+        while True:
+            key, context = self._next_ready()
+            try:
+                payload = self.render(key, context)
+            except Exception as e:
+                logger.error(f"Edit render error for {key}: {e}")
+                continue
+            with self._cond:
+                if payload is None or self._shown.get(key) == payload:
+                    self.skipped += 1
+                    continue
+            try:
+                self.send(key, payload)
+                self.edits += 1
+            except Exception as e:
+                retry = self.retry_after(e) if self.retry_after else None
+                if retry is not None:
+                    # Rate limited: try again later with whatever the state is then
+                    with self._cond:
+                        self._context.setdefault(key, context)
+                        self._due[key] = max(self._due.get(key, 0), time.monotonic() + retry)
+                        self._cond.notify()
+                    logger.warning(f"Edit for {key} rate limited, retrying in {retry}s")
+                    continue
+                if "message is not modified" not in str(e):
+                    self.failed += 1
+                    logger.error(f"Edit error for {key}: {e}")
+                    continue
+                self.skipped += 1
+            with self._cond:
+                self._remember(key, payload)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'edits': self.edits,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'pending': len(self._due)
+            }
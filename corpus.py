@@ -0,0 +1,209 @@
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# On-disk quote corpus.
+#
+#   <base>.dat  header, then records of (u32 length, UTF-8 quote text)
+#   <base>.idx  header, then (u64 record offset, u64 text hash) per record
+#
+# Both files are memory-mapped, so picking a random quote touches one index
+# entry and one record no matter how large the corpus grows.
+DATA_MAGIC = b"H2IQ\x01\x00\x00\x00"
+INDEX_MAGIC = b"H2IX\x01\x00\x00\x00"
+LENGTH = struct.Struct("<I")
+ENTRY = struct.Struct("<QQ")
+
+
+def quote_hash(text):
+    digest = hashlib.blake2b(text.strip().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def format_quote(record):
+    return f"{record.get('quote', '')}\n\n— {record.get('type', 'अनजान')}"
+
+
+class QuoteCorpus:
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.data_path = base_path + ".dat"
+        self.index_path = base_path + ".idx"
+        self._lock = threading.Lock()
+        for path, magic in ((self.data_path, DATA_MAGIC), (self.index_path, INDEX_MAGIC)):
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                with open(path, 'wb') as f:
+                    f.write(magic)
+        self._data = open(self.data_path, 'r+b')
+        self._index = open(self.index_path, 'r+b')
+        if self._data.read(len(DATA_MAGIC)) != DATA_MAGIC or self._index.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{base_path} is not a quote corpus")
+        # Drop a torn trailing index entry left by a crash mid-append
+        index_size = os.path.getsize(self.index_path)
+        whole = len(INDEX_MAGIC) + (index_size - len(INDEX_MAGIC)) // ENTRY.size * ENTRY.size
+        if whole != index_size:
+            self._index.truncate(whole)
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = -1
+        self._remap()
+        self._hashes = {h for _, h in self._entries()}
+
+    def __len__(self):
+        return (os.fstat(self._index.fileno()).st_size - len(INDEX_MAGIC)) // ENTRY.size
+
+    def _remap(self):
+        count = len(self)
+        if count == self._mapped_count:
+            return
+        for m in (self._data_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._data_map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_count = count
+
+    def _entries(self):
+        return ENTRY.iter_unpack(self._index_map[len(INDEX_MAGIC):len(INDEX_MAGIC) + self._mapped_count * ENTRY.size])
+
+    def _record(self, i):
+        offset, _ = ENTRY.unpack_from(self._index_map, len(INDEX_MAGIC) + i * ENTRY.size)
+        (length,) = LENGTH.unpack_from(self._data_map, offset)
+        start = offset + LENGTH.size
+        return self._data_map[start:start + length].decode('utf-8')
+
+    def add(self, text, sync=False):
+        if not text or not text.strip():
+            return False
+        h = quote_hash(text)
+        with self._lock:
+            if h in self._hashes:
+                return False
+            payload = text.encode('utf-8')
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            self._data.write(LENGTH.pack(len(payload)) + payload)
+            self._data.flush()
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(ENTRY.pack(offset, h))
+            self._index.flush()
+            if sync:
+                os.fsync(self._data.fileno())
+                os.fsync(self._index.fileno())
+            self._hashes.add(h)
+        return True
+
+    def random(self, rng=random):
+        with self._lock:
+            self._remap()
+            if self._mapped_count <= 0:
+                return None
+            return self._record(rng.randrange(self._mapped_count))
+
+    def close(self):
+        with self._lock:
+            for m in (self._data_map, self._index_map):
+                if m is not None:
+                    m.close()
+            self._data.close()
+            self._index.close()
+
+    # Check every index entry points at a whole, decodable record with a matching hash
+    def verify(self):
+        problems = []
+        with self._lock:
+            self._remap()
+            data_size = len(self._data_map)
+            seen = set()
+            for i, (offset, h) in enumerate(self._entries()):
+                if offset < len(DATA_MAGIC) or offset + LENGTH.size > data_size:
+                    problems.append(f"entry {i}: offset {offset} out of range")
+                    continue
+                (length,) = LENGTH.unpack_from(self._data_map, offset)
+                if offset + LENGTH.size + length > data_size:
+                    problems.append(f"entry {i}: record overruns data file")
+                    continue
+                try:
+                    text = self._record(i)
+                except UnicodeDecodeError:
+                    problems.append(f"entry {i}: invalid UTF-8")
+                    continue
+                if quote_hash(text) != h:
+                    problems.append(f"entry {i}: hash mismatch")
+                if h in seen:
+                    problems.append(f"entry {i}: duplicate quote")
+                seen.add(h)
+        return problems
+
+
+def build_from_ndjson(ndjson_path, base_path):
+    corpus = QuoteCorpus(base_path)
+    added = skipped = 0
+    with open(ndjson_path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"Line {line_no}: invalid JSON, skipped")
+                skipped += 1
+                continue
+            text = format_quote(record) if isinstance(record, dict) else str(record)
+            if corpus.add(text):
+                added += 1
+            else:
+                skipped += 1
+    os.fsync(corpus._data.fileno())
+    os.fsync(corpus._index.fileno())
+    total = len(corpus)
+    corpus.close()
+    return added, skipped, total
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build and check the offline quote corpus")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build", help="append quotes from an NDJSON file ({\"quote\": ..., \"type\": ...} per line)")
+    p.add_argument("ndjson")
+    p.add_argument("corpus", nargs="?", default="quotes")
+    p = sub.add_parser("verify", help="check the corpus files for corruption")
+    p.add_argument("corpus", nargs="?", default="quotes")
+    p = sub.add_parser("sample", help="print random quotes")
+    p.add_argument("corpus", nargs="?", default="quotes")
+    p.add_argument("-n", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        added, skipped, total = build_from_ndjson(args.ndjson, args.corpus)
+        print(f"Added {added}, skipped {skipped} (duplicates or invalid), corpus now holds {total} quotes")
+        return 0
+    corpus = QuoteCorpus(args.corpus)
+    try:
+        if args.command == "verify":
+            problems = corpus.verify()
+            for problem in problems:
+                print(problem)
+            print(f"{len(corpus)} quotes, {len(problems)} problems")
+            return 1 if problems else 0
+        for _ in range(args.n):
+            print(corpus.random())
+            print("---")
+        return 0
+    finally:
+        corpus.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    return hashlib.sha1("\x1f".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+# Rendered image cache: an LRU memory tier bounded by bytes, plus an optional
+# on-disk tier (also byte-bounded, oldest files evicted) so hits survive restarts.
+class ImageCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, disk_dir=None, disk_max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.avg_render_ms = None
+        self._entries = OrderedDict()  # key -> (data, render_ms)
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(disk_dir) if e.is_file())
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".img")
+
+    def _remember(self, key, data, render_ms):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[0])
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = (data, render_ms)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_ms += entry[1]
+                return entry[0]
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            except OSError as e:
+                logger.error(f"Image cache disk read error: {e}")
+                data = None
+            if data is not None:
+                try:
+                    os.utime(self._disk_path(key))  # keep recently used files off the trim list
+                except OSError:
+                    pass
+                with self._lock:
+                    render_ms = self.avg_render_ms or 0.0
+                    self._remember(key, data, render_ms)
+                    self.disk_hits += 1
+                    self.saved_ms += render_ms
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data, render_ms=0.0):
+        with self._lock:
+            if self.avg_render_ms is None:
+                self.avg_render_ms = render_ms
+            else:
+                self.avg_render_ms = 0.9 * self.avg_render_ms + 0.1 * render_ms
+            self._remember(key, data, render_ms)
+        if self.disk_dir:
+            self._write_disk(key, data)
+
+    def _write_disk(self, key, data):
+        path = self._disk_path(key)
+        try:
+            if os.path.exists(path):
+                return
+            with open(path + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            with self._lock:
+                self._disk_bytes += len(data)
+                over = self._disk_bytes > self.disk_max_bytes
+            if over:
+                self._trim_disk()
+        except OSError as e:
+            logger.error(f"Image cache disk write error: {e}")
+
+    def _trim_disk(self):
+        files = sorted((e for e in os.scandir(self.disk_dir) if e.is_file()), key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in files)
+        for entry in files:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'disk_bytes': self._disk_bytes if self.disk_dir else None,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0,
+            'render_ms_saved': round(self.saved_ms, 1)
+        }
@@ -0,0 +1,353 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    partition INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    partition INTEGER NOT NULL,
+    subscribed INTEGER NOT NULL DEFAULT 0,
+    interval INTEGER,
+    send_type TEXT,
+    last_sent REAL NOT NULL DEFAULT 0,
+    last_quote TEXT,
+    sent_by TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_chats_partition ON chats (partition);
+CREATE INDEX IF NOT EXISTS idx_chats_version ON chats (version);
+"""
+
+CHAT_COLUMNS = "version, chat_id, partition, subscribed, interval, send_type, last_sent, last_quote, sent_by"
+LeaseChat = namedtuple('LeaseChat', [c.strip() for c in CHAT_COLUMNS.split(',')])
+NEXT_VERSION = "(SELECT COALESCE(MAX(version), 0) + 1 FROM chats)"
+CLAIM_SLACK_SECONDS = 1.0
+
+
+def chat_partition(chat_id, partitions):
+    return zlib.crc32(str(chat_id).encode()) % partitions
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# Chat ownership for broadcast workers sharing one SQLite file. Chats hash into a
+# fixed number of partitions; every live worker holds time-limited leases on its
+# share of them and renews them on each heartbeat. When a worker stops
+# heartbeating its leases run out and the others take its partitions over.
+#
+# Sends are claimed before they go out: a claim only succeeds for the current
+# lease holder and only while the chat is still due, and it moves last_sent
+# forward in the same transaction. A partition changing hands therefore can't
+# produce a second send for the same period; a worker that dies between claim
+# and send loses that one message instead.
+class LeaseTable:
+    def __init__(self, path, worker_id=None, partitions=64, ttl=30, default_interval=24 * 3600):
+        self.path = path
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.default_interval = default_interval
+        self.owned = set()
+        self.claims = 0
+        self.conflicts = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(LEASE_SCHEMA)
+        with self._transaction() as c:
+            # The first process fixes the partition count; chat hashing depends on it
+            c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('partitions', ?)", (str(partitions),))
+            self.partitions = int(c.execute("SELECT value FROM meta WHERE key = 'partitions'").fetchone()[0])
+            c.executemany("INSERT OR IGNORE INTO leases (partition) VALUES (?)",
+                          [(p,) for p in range(self.partitions)])
+        if self.partitions != partitions:
+            logger.warning(f"{path} uses {self.partitions} partitions, ignoring configured {partitions}")
+        logger.info(f"Lease table opened at {path} as {self.worker_id}")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def partition(self, chat_id):
+        return chat_partition(chat_id, self.partitions)
+
+    def owns_chat(self, chat_id):
+        return self.partition(chat_id) in self.owned
+
+    # Renew our leases and move towards an even share: shed partitions above it,
+    # take free or expired ones below it. Returns (gained, lost) partition sets.
+    def heartbeat(self, now=None):
+        now = time.time() if now is None else now
+        with self._transaction() as c:
+            c.execute(
+                "INSERT INTO workers (worker_id, heartbeat) VALUES (?, ?) "
+                "ON CONFLICT (worker_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, now)
+            )
+            c.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.ttl,))
+            live = c.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+            share = -(-self.partitions // live)
+            mine, free = [], []
+            for partition, owner, expires in c.execute("SELECT partition, owner, expires FROM leases"):
+                if owner == self.worker_id:
+                    mine.append(partition)
+                elif owner is None or expires <= now:
+                    free.append(partition)
+            keep = mine[:share]
+            take = free[:max(0, share - len(keep))]
+            c.executemany("UPDATE leases SET owner = NULL, expires = 0 WHERE partition = ? AND owner = ?",
+                          [(p, self.worker_id) for p in mine[share:]])
+            c.executemany("UPDATE leases SET owner = ?, expires = ? WHERE partition = ?",
+                          [(self.worker_id, now + self.ttl, p) for p in keep + take])
+        owned = set(keep + take)
+        gained, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        if gained or lost:
+            logger.info(f"Leases for {self.worker_id}: {len(owned)} partitions "
+                        f"(+{len(gained)} -{len(lost)}, {live} workers)")
+        return gained, lost
+
+    # Hand our partitions back right away on a clean shutdown
+    def release(self):
+        with self._transaction() as c:
+            c.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?", (self.worker_id,))
+            c.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+        self.owned = set()
+
+    # rows: (chat_id, subscribed, interval, send_type, last_sent). last_sent only
+    # moves forward unless reset_last_sent, which also forgets who sent last.
+    def publish(self, rows, reset_last_sent=False):
+        last_sent = "excluded.last_sent" if reset_last_sent else "MAX(last_sent, excluded.last_sent)"
+        sent_by = "NULL" if reset_last_sent else "sent_by"
+        with self._transaction() as c:
+            c.executemany(
+                "INSERT INTO chats (chat_id, partition, subscribed, interval, send_type, last_sent, version) "
+                f"VALUES (?, ?, ?, ?, ?, ?, {NEXT_VERSION}) "
+                "ON CONFLICT (chat_id) DO UPDATE SET subscribed = excluded.subscribed, "
+                "interval = excluded.interval, send_type = excluded.send_type, "
+                f"last_sent = {last_sent}, sent_by = {sent_by}, version = excluded.version "
+                "WHERE subscribed IS NOT excluded.subscribed OR interval IS NOT excluded.interval "
+                f"OR send_type IS NOT excluded.send_type OR last_sent IS NOT {last_sent}",
+                [(chat_id, self.partition(chat_id), int(bool(subscribed)), interval, send_type, sent or 0)
+                 for chat_id, subscribed, interval, send_type, sent in rows]
+            )
+
+    def _rows(self, where, params):
+        with self._lock:
+            return [LeaseChat(*row) for row in self.conn.execute(
+                f"SELECT {CHAT_COLUMNS} FROM chats WHERE {where} ORDER BY version", params)]
+
+    def changes(self, after_version):
+        return self._rows("version > ?", (after_version,))
+
+    def chats_in(self, partitions):
+        partitions = list(partitions)
+        if not partitions:
+            return []
+        return self._rows(f"partition IN ({','.join('?' * len(partitions))})", partitions)
+
+    def version(self):
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(version), 0) FROM chats").fetchone()[0]
+
+    # Returns (status, last_sent before the claim). status is 'claimed',
+    # 'not_due' (someone sent this period already), 'not_owner' or 'unsubscribed'.
+    def claim_send(self, chat_id, now=None):
+        now = time.time() if now is None else now
+        with self._transaction() as c:
+            row = c.execute(
+                "SELECT c.subscribed, c.interval, c.last_sent, l.owner, l.expires FROM chats c "
+                "JOIN leases l ON l.partition = c.partition WHERE c.chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+            if row is None or not row[0]:
+                return 'unsubscribed', None
+            subscribed, interval, last_sent, owner, expires = row
+            if owner != self.worker_id or expires <= now:
+                self.conflicts += 1
+                return 'not_owner', last_sent
+            if last_sent + (interval or self.default_interval) > now + CLAIM_SLACK_SECONDS:
+                self.conflicts += 1
+                return 'not_due', last_sent
+            c.execute("UPDATE chats SET last_sent = ?, sent_by = ?, last_quote = NULL WHERE chat_id = ?",
+                      (now, self.worker_id, chat_id))
+        self.claims += 1
+        return 'claimed', last_sent
+
+    # The send went out: publish it so the bot process can record it
+    def finish_send(self, chat_id, sent_at, quote=None):
+        with self._transaction() as c:
+            c.execute(
+                f"UPDATE chats SET last_quote = ?, version = {NEXT_VERSION} "
+                "WHERE chat_id = ? AND last_sent = ? AND sent_by = ?",
+                (quote, chat_id, sent_at, self.worker_id)
+            )
+
+    # The send failed: put last_sent back so the chat is due again
+    def release_send(self, chat_id, previous, sent_at):
+        with self._transaction() as c:
+            c.execute("UPDATE chats SET last_sent = ? WHERE chat_id = ? AND last_sent = ? AND sent_by = ?",
+                      (previous, chat_id, sent_at, self.worker_id))
+
+    def stats(self):
+        return {
+            'worker_id': self.worker_id,
+            'partitions': self.partitions,
+            'owned': len(self.owned),
+            'claims': self.claims,
+            'conflicts': self.conflicts
+        }
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# Local multi-process check: workers poll their partitions and log every send,
+# one of them is killed and a replacement joins half way; afterwards every chat
+# must have been sent once per interval, with no duplicates and no long gaps.
+def _sim_worker(path, worker_id, partitions, ttl, duration):
+    table = LeaseTable(path, worker_id, partitions=partitions, ttl=ttl)
+    log = sqlite3.connect(path, timeout=10)
+    end = time.time() + duration
+    next_beat = 0
+    while time.time() < end:
+        now = time.time()
+        if now >= next_beat:
+            table.heartbeat(now)
+            next_beat = now + ttl / 3
+        for row in table.chats_in(table.owned):
+            if row.subscribed and row.last_sent + row.interval <= now:
+                status, _ = table.claim_send(row.chat_id, now)
+                if status == 'claimed':
+                    log.execute("INSERT INTO sim_sends (chat_id, worker_id, sent_at) VALUES (?, ?, ?)",
+                                (row.chat_id, worker_id, now))
+                    log.commit()
+                    table.finish_send(row.chat_id, now)
+        time.sleep(0.05)
+    table.release()
+
+
+def simulate(workers=3, chats=300, interval=3, ttl=2, partitions=16, duration=15):
+    workdir = tempfile.mkdtemp(prefix="lease-sim-")
+    path = os.path.join(workdir, "leases.db")
+    table = LeaseTable(path, "publisher", partitions=partitions, ttl=ttl, default_interval=interval)
+    table.publish([(-1000000 - i, True, interval, 'text', 0) for i in range(chats)])
+    table.conn.execute("CREATE TABLE sim_sends (chat_id INTEGER, worker_id TEXT, sent_at REAL)")
+    table.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    started = time.time()
+
+    def spawn(name, run_for):
+        process = ctx.Process(target=_sim_worker, args=(path, name, partitions, ttl, run_for))
+        process.start()
+        return process
+
+    processes = [spawn(f"w{i}", duration) for i in range(workers)]
+    time.sleep(duration / 3)
+    os.kill(processes[0].pid, signal.SIGKILL)
+    print(f"{time.time() - started:5.1f}s killed w0")
+    time.sleep(duration / 3)
+    processes.append(spawn("late", duration / 3))
+    print(f"{time.time() - started:5.1f}s started late")
+    for process in processes:
+        process.join()
+    finished = time.time()
+
+    log = sqlite3.connect(path)
+    sends = {}
+    per_worker = {}
+    for chat_id, worker_id, sent_at in log.execute("SELECT chat_id, worker_id, sent_at FROM sim_sends ORDER BY sent_at"):
+        sends.setdefault(chat_id, []).append(sent_at)
+        per_worker[worker_id] = per_worker.get(worker_id, 0) + 1
+    log.close()
+
+    # Handover after a kill waits for the lease to run out, plus a heartbeat or two
+    allowed_gap = interval + ttl + 2 * ttl / 3 + 1
+    duplicates = skipped = 0
+    for chat_id in range(chats):
+        times = sends.get(-1000000 - chat_id, [])
+        if not times or times[-1] < finished - allowed_gap:
+            skipped += 1
+        for before, after in zip(times, times[1:]):
+            if after - before < interval - CLAIM_SLACK_SECONDS:
+                duplicates += 1
+            elif after - before > allowed_gap:
+                skipped += 1
+    total = sum(len(v) for v in sends.values())
+    print(f"{total} sends over {chats} chats; per worker: {per_worker}")
+    print(f"duplicates: {duplicates}, gaps over {allowed_gap:.1f}s: {skipped}")
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+    return 1 if duplicates or skipped else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Broadcast lease table tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("simulate", help="run several local workers against one lease table")
+    p.add_argument("--workers", type=int, default=3)
+    p.add_argument("--chats", type=int, default=300)
+    p.add_argument("--interval", type=float, default=3)
+    p.add_argument("--ttl", type=float, default=2)
+    p.add_argument("--partitions", type=int, default=16)
+    p.add_argument("--duration", type=float, default=15)
+    p = sub.add_parser("show", help="print lease owners of an existing table")
+    p.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "simulate":
+        return simulate(args.workers, args.chats, args.interval, args.ttl, args.partitions, args.duration)
+    conn = sqlite3.connect(args.path)
+    now = time.time()
+    for worker_id, heartbeat in conn.execute("SELECT worker_id, heartbeat FROM workers ORDER BY worker_id"):
+        owned = conn.execute("SELECT COUNT(*) FROM leases WHERE owner = ? AND expires > ?", (worker_id, now)).fetchone()[0]
+        print(f"{worker_id:<32} {owned:>4} partitions, heartbeat {now - heartbeat:5.1f}s ago")
+    free = conn.execute("SELECT COUNT(*) FROM leases WHERE owner IS NULL OR expires <= ?", (now,)).fetchone()[0]
+    print(f"{'(unowned)':<32} {free:>4} partitions")
+    conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import sys
+
+# Process entry point: `python main.py` runs the bot, `python main.py broadcast-worker`
+# a broadcast worker. Render pool workers re-import the main script, so it stays
+# this small and bot.py is only imported by the process that actually runs it.
+if __name__ == "__main__":
+    import bot
+    sys.exit(bot.run(sys.argv[1:]))
@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import deque
+
+from corpus import quote_hash
+
+logger = logging.getLogger(__name__)
+
+
+# Bounded pool of pre-fetched quotes. A background task on the main loop keeps
+# it topped up; commands pop a ready quote and only fetch live when it is empty.
+class QuotePool:
+    def __init__(self, fetch, capacity=20, low_water=5, concurrency=2):
+        self.fetch = fetch
+        self.capacity = capacity
+        self.low_water = low_water
+        self.concurrency = concurrency
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.failures = 0
+        self.last_refill_ms = None
+        self.avg_refill_ms = None
+        self._quotes = deque()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+
+    def depth(self):
+        return len(self._quotes)
+
+    def pop(self):
+        with self._lock:
+            quote = self._quotes.popleft() if self._quotes else None
+            if quote is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            low = len(self._quotes) < self.low_water
+        if low:
+            self._request_refill()
+        return quote
+
+    # Return a quote that was popped but not used (e.g. already seen in that chat)
+    def put_back(self, quote):
+        with self._lock:
+            if len(self._quotes) < self.capacity and quote not in self._quotes:
+                self._quotes.append(quote)
+
+    def _request_refill(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _record_latency(self, elapsed_ms):
+        self.last_refill_ms = elapsed_ms
+        if self.avg_refill_ms is None:
+            self.avg_refill_ms = elapsed_ms
+        else:
+            self.avg_refill_ms = 0.8 * self.avg_refill_ms + 0.2 * elapsed_ms
+
+    async def _fetch_one(self):
+        start = time.perf_counter()
+        try:
+            quote = await self.fetch()
+        except Exception as e:
+            logger.error(f"Quote pool fetch error: {e}")
+            quote = None
+        if not quote:
+            self.failures += 1
+            return False
+        self._record_latency((time.perf_counter() - start) * 1000)
+        with self._lock:
+            if len(self._quotes) < self.capacity and quote not in self._quotes:
+                self._quotes.append(quote)
+                self.fetched += 1
+        return True
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        logger.info(f"Quote pool started (capacity {self.capacity}, low water {self.low_water})")
+        backoff = 1
+        while True:
+            # Top up to capacity whenever we are below the low-water mark
+            if self.depth() < self.low_water:
+                while self.depth() < self.capacity:
+                    batch = min(self.concurrency, self.capacity - self.depth())
+                    results = await asyncio.gather(*(self._fetch_one() for _ in range(batch)))
+                    if not any(results):
+                        break
+                if self.depth() < self.low_water:
+                    # Upstream is failing; back off before trying again
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                    continue
+                backoff = 1
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'capacity': self.capacity,
+            'low_water': self.low_water,
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetched': self.fetched,
+            'failures': self.failures,
+            'last_refill_ms': round(self.last_refill_ms, 1) if self.last_refill_ms is not None else None,
+            'avg_refill_ms': round(self.avg_refill_ms, 1) if self.avg_refill_ms is not None else None
+        }
+
+
+
+# Rolling window of request latencies (ms) for percentile-based decisions
+class LatencyTracker:
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def add(self, latency_ms):
+        self._samples.append(latency_ms)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+# Skips the upstream after consecutive failures; after reset_timeout one trial
+# request is let through (half-open) and its outcome closes or re-opens it.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trips = 0
+        self._trial_running = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._trial_running = False
+        if self.state == "half_open":
+            if self._trial_running:
+                return False
+            self._trial_running = True
+        return True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Quote API circuit closed")
+        self.state = "closed"
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Quote API circuit opened after {self.failures} failures")
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+
+    # The call ended without an outcome (e.g. cancelled); a later call may run the trial
+    def release(self):
+        self._trial_running = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'trips': self.trips
+        }
+
+
+# Latency-aware fetch: if the first attempt has not answered by the p95 of
+# recent latencies a second one is fired and whichever succeeds first wins.
+# All attempts go through the circuit breaker.
+class HedgedFetcher:
+    def __init__(self, fetch_once, breaker=None, min_delay=0.2, max_delay=3.0,
+                 max_hedge_ratio=0.2, min_samples=20):
+        self.fetch_once = fetch_once
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuits = 0
+
+    def hedge_delay(self):
+        if len(self.latency) < self.min_samples:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, self.latency.percentile(95) / 1000))
+
+    async def _attempt(self):
+        start = time.perf_counter()
+        try:
+            result = await self.fetch_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Quote fetch attempt failed: {e}")
+            result = None
+        if result:
+            self.latency.add((time.perf_counter() - start) * 1000)
+        return result
+
+    async def fetch(self):
+        if not self.breaker.allow():
+            self.short_circuits += 1
+            return None
+        self.requests += 1
+        first = asyncio.ensure_future(self._attempt())
+        pending = {first}
+        recorded = False
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay())
+            if not done and self.hedges < self.max_hedge_ratio * self.requests:
+                self.hedges += 1
+                pending.add(asyncio.ensure_future(self._attempt()))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        self.breaker.record_success()
+                        recorded = True
+                        return result
+            self.breaker.record_failure()
+            recorded = True
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if not recorded:
+                self.breaker.release()
+
+    def stats(self):
+        p50, p95, p99 = (self.latency.percentile(p) for p in (50, 95, 99))
+        return {
+            'breaker': self.breaker.stats(),
+            'requests': self.requests,
+            'short_circuits': self.short_circuits,
+            'hedges': self.hedges,
+            'hedge_rate': round(self.hedges / self.requests, 3) if self.requests else 0,
+            'hedge_wins': self.hedge_wins,
+            'hedge_delay_ms': round(self.hedge_delay() * 1000, 1),
+            'latency_ms': {
+                'p50': round(p50, 1) if p50 is not None else None,
+                'p95': round(p95, 1) if p95 is not None else None,
+                'p99': round(p99, 1) if p99 is not None else None
+            }
+        }
+
+# Per-chat memory of recently delivered quotes: a fixed ring of 64-bit
+# fingerprints per chat, kept in a memory-mapped file so it survives restarts
+# and costs ring_size * 8 bytes per chat no matter how many quotes were sent.
+SEEN_MAGIC = b"H2IR\x01\x00\x00\x00"
+SEEN_HEADER = struct.Struct("<8sI")
+SEEN_SLOT_HEAD = struct.Struct("<qI")
+
+
+def quote_fingerprint(quote):
+    return quote_hash(quote) or 1  # 0 marks an empty ring entry
+
+
+class SeenQuotes:
+    def __init__(self, path, ring_size=200):
+        self.path = path
+        self._lock = threading.Lock()
+        if not os.path.exists(path) or os.path.getsize(path) < SEEN_HEADER.size:
+            with open(path, 'wb') as f:
+                f.write(SEEN_HEADER.pack(SEEN_MAGIC, ring_size))
+        self._file = open(path, 'r+b')
+        magic, self.ring_size = SEEN_HEADER.unpack(self._file.read(SEEN_HEADER.size))
+        if magic != SEEN_MAGIC:
+            raise ValueError(f"{path} is not a seen-quotes file")
+        if self.ring_size != ring_size:
+            logger.warning(f"{path} uses ring size {self.ring_size}, ignoring configured {ring_size}")
+        self.slot_size = SEEN_SLOT_HEAD.size + 8 * self.ring_size
+        size = os.path.getsize(path)
+        count = (size - SEEN_HEADER.size) // self.slot_size
+        if SEEN_HEADER.size + count * self.slot_size != size:
+            self._file.truncate(SEEN_HEADER.size + count * self.slot_size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._slots = {}
+        for i in range(count):
+            chat_id, _ = SEEN_SLOT_HEAD.unpack_from(self._mmap, self._offset(i))
+            self._slots[chat_id] = i
+
+    def _offset(self, slot):
+        return SEEN_HEADER.size + slot * self.slot_size
+
+    def _new_slot(self, chat_id):
+        slot = len(self._slots)
+        self._mmap.close()
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(SEEN_SLOT_HEAD.pack(chat_id, 0) + bytes(8 * self.ring_size))
+        self._file.flush()
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._slots[chat_id] = slot
+        return slot
+
+    def seen(self, chat_id, quote):
+        with self._lock:
+            slot = self._slots.get(chat_id)
+            if slot is None:
+                return False
+            start = self._offset(slot) + SEEN_SLOT_HEAD.size
+            ring = array('Q', self._mmap[start:start + 8 * self.ring_size])
+        return quote_fingerprint(quote) in ring
+
+    def add(self, chat_id, quote):
+        fingerprint = quote_fingerprint(quote)
+        with self._lock:
+            slot = self._slots.get(chat_id)
+            if slot is None:
+                slot = self._new_slot(chat_id)
+            offset = self._offset(slot)
+            _, position = SEEN_SLOT_HEAD.unpack_from(self._mmap, offset)
+            struct.pack_into("<Q", self._mmap, offset + SEEN_SLOT_HEAD.size + 8 * position, fingerprint)
+            SEEN_SLOT_HEAD.pack_into(self._mmap, offset, chat_id, (position + 1) % self.ring_size)
+
+    def flush(self):
+        with self._lock:
+            self._mmap.flush()
+
+    def stats(self):
+        return {
+            'chats': len(self._slots),
+            'ring_size': self.ring_size,
+            'bytes': SEEN_HEADER.size + len(self._slots) * self.slot_size
+        }
@@ -0,0 +1,642 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+# Quote card rendering. Everything that does not depend on the quote (background,
+# title, divider, watermark) is drawn once per template into a base image; a card
+# is a copy of that base with only the quote body and author drawn on top.
+CARD_SIZE = 1080
+RENDER_VERSION = 4  # bump when the card layout changes
+
+
+class Template:
+    def __init__(self, name, background=(255, 255, 255), title="🌟 आज का विचार 🌟",
+                 title_color=(0, 0, 0), body_color=(50, 50, 50), author_color=(100, 100, 100),
+                 line_color=(200, 200, 200), watermark="© H2I Quotes", watermark_color=(150, 150, 150)):
+        self.name = name
+        self.background = background
+        self.title = title
+        self.title_color = title_color
+        self.body_color = body_color
+        self.author_color = author_color
+        self.line_color = line_color
+        self.watermark = watermark
+        self.watermark_color = watermark_color
+
+    def cache_parts(self):
+        return (self.name, self.background, self.title, self.title_color, self.body_color,
+                self.author_color, self.line_color, self.watermark, self.watermark_color)
+
+
+DEFAULT_TEMPLATE = "classic"
+TEMPLATES = {
+    "classic": Template("classic"),
+    "dark": Template("dark", background=(24, 24, 32), title_color=(255, 215, 120),
+                     body_color=(235, 235, 235), author_color=(180, 180, 190),
+                     line_color=(70, 70, 85), watermark_color=(120, 120, 135)),
+    "warm": Template("warm", background=(253, 243, 224), title_color=(120, 60, 20),
+                     body_color=(70, 45, 30), author_color=(130, 90, 60),
+                     line_color=(225, 200, 160), watermark_color=(170, 135, 100)),
+}
+
+
+# Font faces are opened lazily per (file, size) and chosen per run of text by
+# glyph coverage, so Devanagari, Latin and symbols each come from a face that
+# actually has them. Missing files are skipped.
+FONT_CHAINS = {
+    'devanagari': ["fonts/NotoSansDevanagari-Regular.ttf", "fonts/DejaVuSans.ttf"],
+    'latin': ["fonts/LiberationSans-Regular.ttf", "fonts/DejaVuSans.ttf", "fonts/DroidSans.ttf"],
+    'symbol': ["fonts/DejaVuSans.ttf", "fonts/LiberationSans-Regular.ttf", "fonts/NotoSansDevanagari-Regular.ttf"],
+}
+# Stand-ins for characters no bundled face has (there is no colour emoji font)
+FONT_SUBSTITUTES = {
+    "🌟": "★",
+    "⭐": "★",
+    "✨": "✦",
+    "❤": "♥",
+    "💖": "♥",
+}
+NOTDEF_PROBE = "\uffff"
+
+
+# Script of a character, or None for characters that can go with any run
+# (spaces, digits, punctuation, joiners)
+def char_script(ch):
+    o = ord(ch)
+    if 0x0900 <= o <= 0x097F or 0xA8E0 <= o <= 0xA8FF or 0x1CD0 <= o <= 0x1CFF:
+        return 'devanagari'
+    if ch.isspace() or 0x2000 <= o <= 0x206F or 0xFE00 <= o <= 0xFE0F or (o < 0x250 and not ch.isalpha()):
+        return None
+    if o < 0x250 or 0x1E00 <= o <= 0x1EFF:
+        return 'latin'
+    return 'symbol'
+
+
+class FontRegistry:
+    def __init__(self, chains=None):
+        chains = chains or FONT_CHAINS
+        self.chains = {script: [path for path in paths if os.path.exists(path)] for script, paths in chains.items()}
+        self.paths = list(dict.fromkeys(path for paths in self.chains.values() for path in paths))
+        self.primary = (self.chains.get('devanagari') or self.paths or [None])[0]
+        self._faces = {}
+        self._coverage = {path: {} for path in self.paths}
+        self._picks = {}
+        self._lock = threading.Lock()
+
+    def face(self, path, size):
+        key = (path, size)
+        font = self._faces.get(key)
+        if font is None:
+            with self._lock:
+                font = self._faces.get(key)
+                if font is None:
+                    font = ImageFont.truetype(path, size) if path else ImageFont.load_default(size=size)
+                    self._faces[key] = font
+        return font
+
+    # A glyph is covered when it does not rasterize to the face's .notdef box
+    def covers(self, path, ch):
+        if path is None:
+            return True
+        coverage = self._coverage[path]
+        covered = coverage.get(ch)
+        if covered is None:
+            font = self.face(path, 20)
+            probe = font.getmask(NOTDEF_PROBE)
+            mask = font.getmask(ch)
+            covered = coverage[ch] = ch.isspace() or (bytes(mask), mask.size) != (bytes(probe), probe.size)
+        return covered
+
+    # (path, character to draw) for a character that cannot join the current run
+    def _pick(self, ch):
+        pick = self._picks.get(ch)
+        if pick is None:
+            chain = self.chains.get(char_script(ch) or 'latin') or []
+            path = next((p for p in chain + self.paths if self.covers(p, ch)), None)
+            if path is not None:
+                pick = (path, ch)
+            elif ch in FONT_SUBSTITUTES:
+                pick = self._pick(FONT_SUBSTITUTES[ch])
+            elif unicodedata.category(ch) in ('Mn', 'Cf'):
+                pick = (None, "")  # invisible mark nobody has; drop it
+            else:
+                pick = ((chain or self.paths or [None])[0], ch)
+            self._picks[ch] = pick
+        return pick
+
+    def runs(self, text, size):
+        runs = []
+        current = None
+        chars = []
+        for ch in text:
+            if current is not None and char_script(ch) is None and self.covers(current, ch):
+                chars.append(ch)
+                continue
+            path, drawn = self._pick(ch)
+            if not drawn:
+                continue
+            if path != current and chars:
+                runs.append((self.face(current, size), "".join(chars)))
+                chars = []
+            current = path
+            chars.append(drawn)
+        if chars:
+            runs.append((self.face(current, size), "".join(chars)))
+        return runs
+
+    def text_width(self, text, size):
+        return sum(font.getlength(run) for font, run in self.runs(text, size))
+
+    def ascent(self, size):
+        return self.face(self.primary, size).getmetrics()[0]
+
+    # Draws text with its top-left at xy; runs from different faces share one baseline
+    def draw_text(self, draw, xy, text, size, fill):
+        x, y = xy
+        baseline = y + self.ascent(size)
+        for font, run in self.runs(text, size):
+            draw.text((x, baseline), run, font=font, fill=fill, anchor="ls")
+            x += font.getlength(run)
+
+    def cache_parts(self):
+        return tuple(self.paths)
+
+    def stats(self):
+        return {
+            'files': len(self.paths),
+            'faces_loaded': len(self._faces),
+            'chars_checked': sum(len(c) for c in self._coverage.values())
+        }
+
+
+# Encoders for the finished card. Lossy formats take a quality; the palette PNG
+# takes a colour count instead (text cards need very few colours).
+def _encode_jpeg(img, quality):
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def _encode_progressive_jpeg(img, quality):
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def _encode_webp(img, quality):
+    out = BytesIO()
+    img.save(out, format='WEBP', quality=quality, method=4)
+    return out.getvalue()
+
+
+def _encode_palette_png(img, colors):
+    out = BytesIO()
+    img.quantize(colors=colors).save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+
+# name -> (encoder, highest setting, lowest setting)
+ENCODERS = {
+    'jpeg': (_encode_jpeg, 95, 50),
+    'pjpeg': (_encode_progressive_jpeg, 95, 50),
+    'webp': (_encode_webp, 90, 40),
+    'png': (_encode_palette_png, 256, 8),
+}
+
+
+# Output format plus an optional byte budget. With a budget the highest setting
+# that fits is found by binary search (the first try at full quality usually
+# fits, so most cards cost a single encode); without one the top setting is used.
+class Encoding:
+    def __init__(self, fmt='jpeg', max_bytes=None, quality=None):
+        if fmt not in ENCODERS:
+            raise ValueError(f"unknown image format {fmt!r}, expected one of {', '.join(ENCODERS)}")
+        self.fmt = fmt
+        self.max_bytes = max_bytes or None
+        _, high, self.min_quality = ENCODERS[fmt]
+        self.quality = quality or high
+
+    def cache_parts(self):
+        return (self.fmt, self.quality, self.max_bytes)
+
+    def encode(self, img):
+        encoder = ENCODERS[self.fmt][0]
+        data = encoder(img, self.quality)
+        if self.max_bytes is None or len(data) <= self.max_bytes:
+            return data, self.quality
+        low, high = self.min_quality, self.quality - 1
+        best = None
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = encoder(img, quality)
+            if len(candidate) <= self.max_bytes:
+                best = (candidate, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        # Nothing fits: send the smallest we are willing to make
+        return best or (encoder(img, self.min_quality), self.min_quality)
+
+
+DEFAULT_ENCODING = Encoding()
+
+
+# Body text layout measured in pixels. Each word's advance width is cached per
+# font size, so wrapping a line costs one dict lookup per word and FreeType is
+# only asked about words it has not seen at that size.
+BODY_BOX = (100, 230, 980, 770)  # left, top, right, bottom
+BODY_MAX_SIZE = 56
+BODY_MIN_SIZE = 24
+BODY_LINE_SPACING = 1.5
+
+
+class TextLayout:
+    def __init__(self, fonts, max_size=BODY_MAX_SIZE, min_size=BODY_MIN_SIZE, step=2, max_words=20000):
+        self.fonts = fonts
+        self.sizes = list(range(max_size, min_size - 1, -step))
+        self.max_words = max_words
+        self.measure_calls = 0
+        self.cache_hits = 0
+        self._widths = {}
+
+    def width(self, text, size):
+        widths = self._widths.get(size)
+        if widths is None:
+            widths = self._widths[size] = {}
+        w = widths.get(text)
+        if w is None:
+            if len(widths) >= self.max_words:
+                widths.clear()
+            self.measure_calls += 1
+            w = widths[text] = self.fonts.text_width(text, size)
+        else:
+            self.cache_hits += 1
+        return w
+
+    # Greedy wrap of one paragraph; a word wider than the line is split by character
+    def _wrap_paragraph(self, paragraph, size, max_width):
+        space = self.width(" ", size)
+        lines = []
+        words = []
+        line_width = 0
+        for word in paragraph.split():
+            w = self.width(word, size)
+            if w > max_width:
+                pieces = []
+                piece = ""
+                for ch in word:
+                    if piece and self.width(piece + ch, size) > max_width:
+                        pieces.append(piece)
+                        piece = ""
+                    piece += ch
+                pieces.append(piece)
+            else:
+                pieces = [word]
+            for piece in pieces:
+                w = self.width(piece, size)
+                if words and line_width + space + w > max_width:
+                    lines.append((" ".join(words), line_width))
+                    words, line_width = [], 0
+                line_width += w + (space if words else 0)
+                words.append(piece)
+        if words:
+            lines.append((" ".join(words), line_width))
+        return lines
+
+    def wrap(self, text, size, max_width):
+        lines = []
+        for paragraph in text.split('\n'):
+            lines.extend(self._wrap_paragraph(paragraph, size, max_width))
+        return lines
+
+    # Largest size whose wrapped block fits the box; the smallest size is used if none does
+    def fit(self, text, max_width, max_height, line_spacing=BODY_LINE_SPACING):
+        for size in self.sizes:
+            lines = self.wrap(text, size, max_width)
+            line_height = int(size * line_spacing)
+            if len(lines) * line_height <= max_height or size == self.sizes[-1]:
+                return size, lines, line_height
+
+    def stats(self):
+        return {
+            'measure_calls': self.measure_calls,
+            'cache_hits': self.cache_hits,
+            'cached_words': sum(len(w) for w in self._widths.values())
+        }
+
+
+TITLE_SIZE = 60
+CONTENT_SIZE = 40
+
+
+class CardRenderer:
+    def __init__(self, fonts, templates=None):
+        self.fonts = fonts
+        self.templates = templates if templates is not None else TEMPLATES
+        self.layout = TextLayout(fonts)
+        self._bases = {}
+        self._lock = threading.Lock()
+
+    def template(self, name):
+        return self.templates.get(name) or self.templates[DEFAULT_TEMPLATE]
+
+    def _draw_base(self, template):
+        img = Image.new('RGB', (CARD_SIZE, CARD_SIZE), color=template.background)
+        draw = ImageDraw.Draw(img)
+        w = self.fonts.text_width(template.title, TITLE_SIZE)
+        self.fonts.draw_text(draw, ((CARD_SIZE - w)/2, 100), template.title, TITLE_SIZE, template.title_color)
+        draw.line([(100, 900), (980, 900)], fill=template.line_color, width=2)
+        w = self.fonts.text_width(template.watermark, CONTENT_SIZE)
+        self.fonts.draw_text(draw, (CARD_SIZE - w - 50, 950), template.watermark, CONTENT_SIZE, template.watermark_color)
+        return img
+
+    def base(self, name):
+        template = self.template(name)
+        with self._lock:
+            img = self._bases.get(template.name)
+            if img is None:
+                img = self._bases[template.name] = self._draw_base(template)
+                logger.info(f"Rendered base layer for template {template.name}")
+        return img
+
+    # Build every base layer up front so the first card of each template is cheap too
+    def warm(self):
+        for name in self.templates:
+            self.base(name)
+
+    def cache_parts(self, name):
+        return (RENDER_VERSION, CARD_SIZE, *self.fonts.cache_parts(), *self.template(name).cache_parts())
+
+    def render(self, quote_text, name=DEFAULT_TEMPLATE, encoding=DEFAULT_ENCODING):
+        return encoding.encode(self.draw_card(quote_text, name))[0]
+
+    def draw_card(self, quote_text, name=DEFAULT_TEMPLATE):
+        template = self.template(name)
+        img = self.base(template.name).copy()
+        draw = ImageDraw.Draw(img)
+
+        parts = quote_text.split('\n\n— ')
+        quote = parts[0]
+        author = "— " + parts[1] if len(parts) > 1 else ""
+
+        left, top, right, bottom = BODY_BOX
+        size, lines, line_height = self.layout.fit(quote, right - left, bottom - top)
+        y_position = top + (bottom - top - len(lines) * line_height) / 2
+        for line, w in lines:
+            self.fonts.draw_text(draw, (left + (right - left - w)/2, y_position), line, size, template.body_color)
+            y_position += line_height
+
+        if author:
+            w = self.layout.width(author, CONTENT_SIZE)
+            self.fonts.draw_text(draw, (CARD_SIZE - w - 100, 800), author, CONTENT_SIZE, template.author_color)
+
+        return img
+
+
+# Each pool worker builds every template base once; body faces load on first use
+_worker_renderer = None
+
+
+def _init_worker(font_chains):
+    global _worker_renderer
+    _worker_renderer = CardRenderer(FontRegistry(font_chains))
+    _worker_renderer.warm()
+
+
+def _render_job(quote_text, template, encoding):
+    return _worker_renderer.render(quote_text, template, encoding)
+
+
+def _ping():
+    return os.getpid()
+
+
+# Renders cards in a process pool so PIL work never runs on the webhook thread or
+# the event loop. At most max_pending jobs are in flight; callers wait up to
+# queue_timeout for a slot and job_timeout for the result, then get None.
+class RenderService:
+    def __init__(self, font_chains=None, workers=None, max_pending=32, job_timeout=15, queue_timeout=5):
+        self.font_chains = font_chains
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.queue_timeout = queue_timeout
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.restarts = 0
+        self.avg_render_ms = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._restarting = False
+        self._stopped = False
+
+    # Workers come from a forkserver, never from this process: the pool is also
+    # rebuilt after a crash, when the bot's threads and locks are live. The new
+    # pool is only published once a worker has answered.
+    def _create_pool(self):
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['render'])
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.font_chains,))
+        try:
+            pool.submit(_ping).result(timeout=60)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        return pool
+
+    def start(self):
+        self._stopped = False
+        self._start()
+
+    def _start(self):
+        if self._pool is not None:
+            return
+        pool = self._create_pool()
+        with self._lock:
+            if self._pool is None and not self._stopped:
+                self._pool, pool = pool, None
+        if pool is not None:
+            # stop() or another start() got there first
+            pool.shutdown(wait=False, cancel_futures=True)
+            return
+        logger.info(f"Render service started with {self.workers} workers")
+
+    def stop(self, wait=False):
+        with self._lock:
+            self._stopped = True
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
+
+    def running(self):
+        return self._pool is not None
+
+    def _submit(self, pool, quote_text, template, encoding):
+        if pool is None:
+            raise RuntimeError("render service is not running")
+        future = pool.submit(_render_job, quote_text, template, encoding)
+        with self._lock:
+            self.submitted += 1
+        start = time.perf_counter()
+
+        # The slot is held until the worker actually finishes, even after a caller timed out
+        def done(f):
+            self._slots.release()
+            if f.cancelled() or f.exception() is not None:
+                return
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.completed += 1
+                self.avg_render_ms = elapsed if self.avg_render_ms is None else 0.9 * self.avg_render_ms + 0.1 * elapsed
+
+        future.add_done_callback(done)
+        return future
+
+    # pool is the one the job went to; a late failure from a replaced pool is only counted
+    def _failed(self, e, pool):
+        restart = False
+        with self._lock:
+            self.failures += 1
+            if isinstance(e, BrokenProcessPool) and pool is not None and self._pool is pool:
+                # A worker died; callers render inline until the replacement is up
+                self._pool = None
+                self.restarts += 1
+                restart = not self._restarting
+                self._restarting = True
+        if pool is not None and self._pool is not pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if not restart:
+            if not isinstance(e, BrokenProcessPool):
+                logger.error(f"Render job failed: {e}")
+            return
+        logger.error("Render pool broken, restarting workers")
+        threading.Thread(target=self._restart, name="RenderRestart", daemon=True).start()
+
+    def _restart(self):
+        try:
+            self._start()
+        except Exception as e:
+            logger.error(f"Render service restart failed: {e}")
+        finally:
+            self._restarting = False
+
+    def _acquire_failed(self):
+        self.rejected += 1
+        logger.warning("Render queue full, job rejected")
+        return None
+
+    def render(self, quote_text, template, encoding=DEFAULT_ENCODING):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            return self._acquire_failed()
+        pool = self._pool
+        try:
+            future = self._submit(pool, quote_text, template, encoding)
+        except Exception as e:
+            self._slots.release()
+            self._failed(e, pool)
+            return None
+        try:
+            return future.result(timeout=self.job_timeout)
+        except FutureTimeout:
+            self.timeouts += 1
+            logger.warning(f"Render job timed out after {self.job_timeout}s")
+        except Exception as e:
+            self._failed(e, pool)
+        return None
+
+    async def render_async(self, quote_text, template, encoding=DEFAULT_ENCODING):
+        deadline = time.monotonic() + self.queue_timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                return self._acquire_failed()
+            await asyncio.sleep(0.05)
+        pool = self._pool
+        try:
+            future = self._submit(pool, quote_text, template, encoding)
+        except Exception as e:
+            self._slots.release()
+            self._failed(e, pool)
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.job_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Render job timed out after {self.job_timeout}s")
+        except Exception as e:
+            self._failed(e, pool)
+        return None
+
+    def stats(self):
+        return {
+            'workers': self.workers if self._pool is not None else 0,
+            'max_pending': self.max_pending,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'restarts': self.restarts,
+            'avg_render_ms': round(self.avg_render_ms, 1) if self.avg_render_ms is not None else None
+        }
+
+
+SAMPLE_QUOTE = "जीवन एक यात्रा है, मंजिल नहीं। हर दिन कुछ नया सीखो और आगे बढ़ो।\n\n— अज्ञात"
+
+
+# Bytes and encode time of one card in every format, with and without a budget
+def encode_report(quote_text=SAMPLE_QUOTE, template=DEFAULT_TEMPLATE, budgets=(None, 60000, 30000), rounds=5):
+    img = CardRenderer(FontRegistry()).draw_card(quote_text, template)
+    rows = []
+    for fmt in ENCODERS:
+        for budget in budgets:
+            encoding = Encoding(fmt, budget)
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                data, quality = encoding.encode(img)
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            rows.append((fmt, budget, quality, len(data), best))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quote card rendering tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("encode-report", help="bytes and encode time per format and byte budget")
+    p.add_argument("--quote", default=SAMPLE_QUOTE)
+    p.add_argument("--template", default=DEFAULT_TEMPLATE, choices=list(TEMPLATES))
+    p.add_argument("--budget", type=int, action="append", help="byte budget to try (repeatable)")
+    p.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    budgets = [None] + (args.budget or [60000, 30000])
+    print(f"{'format':<7} {'budget':>8} {'quality':>7} {'bytes':>9} {'ms':>8}")
+    for fmt, budget, quality, size, ms in encode_report(args.quote, args.template, budgets, rounds=args.rounds):
+        print(f"{fmt:<7} {budget or '-':>8} {quality:>7} {size:>9,} {ms:>8.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from image_cache import ImageCache
+from render import Encoding, RenderService, ENCODERS, DEFAULT_TEMPLATE, TEMPLATES
+
+# Rendering benchmark. Drives bot.generate_quote_image() (cache lookup, render,
+# encode) over a fixed quote set, inline and through the worker pool, and can
+# compare the numbers against a saved baseline. Every path runs in its own
+# subprocess so peak RSS is per path rather than a running maximum.
+BENCH_QUOTES = {
+    'short': [
+        "सच्चाई की जीत होती है।\n\n— अज्ञात",
+        "कर्म ही पूजा है।\n\n— महात्मा गांधी",
+        "Be yourself.\n\n— Oscar Wilde",
+    ],
+    'long': [
+        " ".join(["जीवन एक यात्रा है, मंजिल नहीं। हर दिन कुछ नया सीखो और आगे बढ़ो।"] * 5) + "\n\n— स्वामी विवेकानंद",
+        " ".join(["The only way to do great work is to love what you do, and keep looking until you find it."] * 3)
+        + "\n\n— Steve Jobs",
+    ],
+    'devanagari': [
+        "उठो, जागो और तब तक मत रुको जब तक लक्ष्य प्राप्त न हो जाए।\n\n— स्वामी विवेकानंद",
+        "जो व्यक्ति अपने क्रोध को स्वयं सहन कर लेता है,\nवह दूसरों के क्रोध से बच जाता है।\n\n— चाणक्य",
+        "सपने वो नहीं जो हम सोते हुए देखते हैं, सपने वो हैं जो हमें सोने नहीं देते।\n\n— ए.पी.जे. अब्दुल कलाम",
+    ],
+    'mixed': [
+        "Life is a journey — जीवन एक यात्रा है ★ 2024\n\n— Swami विवेकानंद",
+        "Success का कोई shortcut नहीं होता, बस hard work 💖\n\n— अज्ञात",
+    ],
+}
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)  # ru_maxrss is in KiB on Linux
+
+
+# bot.py refuses to import without credentials; the bench never talks to Telegram
+BENCH_ENV = {'BOT_TOKEN': "0:bench", 'API_ID': "1", 'API_HASH': "bench", 'BOT_OWNER_ID': "1"}
+
+
+def load_bot(fmt, max_bytes):
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    logging.disable(logging.INFO)  # bot.py logs its startup at INFO
+    import bot
+    bot.image_encoding = Encoding(fmt, max_bytes)
+    bot.image_cache = ImageCache()
+    return bot
+
+
+def bench_quotes(rounds):
+    quotes = []
+    for category, texts in BENCH_QUOTES.items():
+        for i, text in enumerate(texts):
+            for r in range(rounds):
+                # A per-round suffix keeps every render a cache miss
+                quotes.append((category, f"{text}\u200b{i}.{r}" if r else text))
+    return quotes
+
+
+def summarize(name, latencies, sizes, elapsed):
+    return {
+        'name': name,
+        'cards': len(latencies),
+        'cards_per_sec': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'avg_bytes': int(sum(sizes) / len(sizes)),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_inline(fmt, rounds, template, max_bytes):
+    bot = load_bot(fmt, max_bytes)
+    bot.card_renderer.warm()
+    latencies, sizes, by_category = [], [], {}
+    started = time.perf_counter()
+    for category, quote in bench_quotes(rounds):
+        start = time.perf_counter()
+        data = bot.generate_quote_image(quote, template)
+        elapsed = (time.perf_counter() - start) * 1000
+        latencies.append(elapsed)
+        sizes.append(len(data.getvalue()))
+        by_category.setdefault(category, []).append(elapsed)
+    result = summarize(f"inline/{fmt}", latencies, sizes, time.perf_counter() - started)
+    result['p50_ms_by_category'] = {c: round(percentile(v, 50), 2) for c, v in by_category.items()}
+    return result
+
+
+def bench_cached(rounds, template):
+    bot = load_bot('jpeg', None)
+    texts = [text for texts in BENCH_QUOTES.values() for text in texts]
+    for text in texts:
+        bot.generate_quote_image(text, template)
+    latencies, sizes = [], []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            start = time.perf_counter()
+            data = bot.generate_quote_image(text, template)
+            latencies.append((time.perf_counter() - start) * 1000)
+            sizes.append(len(data.getvalue()))
+    return summarize("cached", latencies, sizes, time.perf_counter() - started)
+
+
+def bench_pool(workers, rounds, template, max_bytes):
+    bot = load_bot('jpeg', max_bytes)
+    bot.render_service = RenderService(workers=workers, max_pending=max(32, workers * 4))
+    bot.render_service.start()
+    quotes = bench_quotes(rounds)
+
+    async def run():
+        async def one(quote):
+            start = time.perf_counter()
+            data = await bot.generate_quote_image_async(quote, template)
+            return (time.perf_counter() - start) * 1000, len(data.getvalue()) if data else 0
+        return await asyncio.gather(*(one(quote) for _, quote in quotes))
+
+    try:
+        started = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.render_service.stop(wait=True)
+    result = summarize(f"pool/{workers}", [r[0] for r in results], [r[1] for r in results], elapsed)
+    result['failed'] = sum(1 for r in results if not r[1])
+    return result
+
+
+def run_path(path, rounds, template, max_bytes):
+    kind, _, arg = path.partition("/")
+    if kind == "inline":
+        return bench_inline(arg, rounds, template, max_bytes)
+    if kind == "cached":
+        return bench_cached(rounds * 10, template)
+    return bench_pool(int(arg), rounds, template, max_bytes)
+
+
+def run_suite(rounds=3, template=DEFAULT_TEMPLATE, formats=None, workers=None, max_bytes=None):
+    paths = [f"inline/{fmt}" for fmt in formats or list(ENCODERS)]
+    paths += ["cached", f"pool/{workers or os.cpu_count() or 1}"]
+    results = []
+    for path in paths:
+        cmd = [sys.executable, os.path.abspath(__file__), "--path", path, "--rounds", str(rounds),
+               "--template", template]
+        if max_bytes is not None:
+            cmd += ["--max-bytes", str(max_bytes)]
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return results
+
+
+def print_results(results):
+    print(f"{'path':<14} {'cards':>6} {'cards/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'bytes':>9} {'rss MB':>7}")
+    for r in results:
+        print(f"{r['name']:<14} {r['cards']:>6} {r['cards_per_sec']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8} "
+              f"{r['avg_bytes']:>9,} {r['peak_rss_mb']:>7}")
+
+
+# Regression when latency or size grows by more than tolerance, or throughput drops by it.
+# Latency changes under MIN_MS_DELTA are timer noise on sub-millisecond paths.
+MIN_MS_DELTA = 0.5
+
+
+def compare(results, baseline, tolerance):
+    previous = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get(r['name'])
+        if old is None:
+            continue
+        for metric, worse_if_higher in (('p50_ms', True), ('p99_ms', True), ('avg_bytes', True),
+                                        ('cards_per_sec', False)):
+            before, after = old.get(metric), r.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            flag = change > tolerance if worse_if_higher else change < -tolerance
+            if metric.endswith('_ms') and after - before < MIN_MS_DELTA:
+                flag = False
+            print(f"{r['name']:<14} {metric:<14} {before:>10} -> {after:<10} {change:+7.1%}{'  REGRESSION' if flag else ''}")
+            if flag:
+                regressions.append((r['name'], metric))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark quote card rendering")
+    parser.add_argument("--rounds", type=int, default=3, help="passes over the quote set per path")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE, choices=list(TEMPLATES))
+    parser.add_argument("--format", action="append", choices=list(ENCODERS), help="format to bench (repeatable)")
+    parser.add_argument("--workers", type=int, help="render pool size (default: cores)")
+    parser.add_argument("--max-bytes", type=int, help="byte budget for lossy formats")
+    parser.add_argument("--save", help="write results to this baseline file")
+    parser.add_argument("--compare", help="compare against a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--path", help=argparse.SUPPRESS)  # one path, run by run_suite in a subprocess
+    args = parser.parse_args(argv)
+
+    if args.path:
+        print(json.dumps(run_path(args.path, args.rounds, args.template, args.max_bytes)))
+        return 0
+    results = run_suite(args.rounds, args.template, args.format, args.workers, args.max_bytes)
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'created': time.strftime("%Y-%m-%dT%H:%M:%S"), 'cpus': os.cpu_count(),
+                       'rounds': args.rounds, 'results': results}, f, indent=2)
+        print(f"Baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('rounds') != args.rounds or baseline.get('cpus') != os.cpu_count():
+            print("Warning: baseline was taken with different rounds or core count; pool latency is not comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"{len(regressions)} regressions against {args.compare}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import asyncio
+import heapq
+import threading
+import time
+
+# Min-heap of (due time, chat_id). Rescheduling pushes a new entry and leaves the
+# old one behind; stale entries are recognised by comparing against _due and are
+# skipped when they reach the top, so every change costs O(log n).
+class DueScheduler:
+    def __init__(self, max_sleep=300):
+        self.max_sleep = max_sleep
+        self._heap = []
+        self._due = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._due
+
+    def bind(self, loop):
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+
+    def _notify(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _compact(self):
+        # Rebuild once stale entries outnumber live ones
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, chat_id) for chat_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def set(self, chat_id, due):
+        with self._lock:
+            earlier = not self._heap or due < self._heap[0][0]
+            self._due[chat_id] = due
+            heapq.heappush(self._heap, (due, chat_id))
+            self._compact()
+        if earlier:
+            self._notify()
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._due.pop(chat_id, None)
+
+    def due_at(self, chat_id):
+        return self._due.get(chat_id)
+
+    def _drop_stale(self):
+        while self._heap:
+            due, chat_id = self._heap[0]
+            if self._due.get(chat_id) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def next_due(self):
+        with self._lock:
+            return self._drop_stale()
+
+    # Remove and return every chat whose due time has passed
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due_chats = []
+        with self._lock:
+            while True:
+                due = self._drop_stale()
+                if due is None or due > now:
+                    break
+                _, chat_id = heapq.heappop(self._heap)
+                del self._due[chat_id]
+                due_chats.append(chat_id)
+        return due_chats
+
+    # Sleep until the earliest deadline, or until an earlier one is scheduled
+    async def wait(self):
+        due = self.next_due()
+        delay = self.max_sleep if due is None else min(self.max_sleep, due - time.time())
+        if delay <= 0:
+            return
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self):
+        due = self.next_due()
+        return {
+            'chats': len(self._due),
+            'heap_entries': len(self._heap),
+            'next_due_in_s': round(due - time.time(), 1) if due is not None else None
+        }
@@ -0,0 +1,360 @@
+import argparse
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from storage import normalize_state
+
+# Compact binary snapshot of the bot state.
+#
+# Layout (little endian):
+#   header
+#   name blob      - UTF-8 bytes of every interned string (names, bucket keys, ...)
+#   name offsets   - u32 offsets into the blob, one per string plus an end marker
+#   chats          - (chat_id, quote_count, send_type name index or -1, subscribed,
+#                     interval or 0, last sent time) per chat
+#   stats          - (user_id, chat_id, join_date index, reactions, requests) per entry
+#   leaderboards   - one block per chat, decoded only when that chat is touched
+#   index          - (chat_id, offset, length) of every leaderboard block
+MAGIC = b"H2IS"
+VERSION = 2
+HEADER = struct.Struct("<4sHxxQQ" + "QI" * 5)
+CHAT = struct.Struct("<qIiBId")
+CHAT_V1 = struct.Struct("<qIi")  # version 1 chats carried no schedule fields
+STAT = struct.Struct("<qqIII")
+INDEX = struct.Struct("<qQI")
+USER = struct.Struct("<qIIHH")
+BUCKET = struct.Struct("<II")
+
+
+def encode_snapshot(state, leaderboard_items=None, journal_seq=0):
+    names = {}
+    blob = bytearray()
+    offsets = [0]
+
+    def intern(text):
+        index = names.get(text)
+        if index is None:
+            index = names[text] = len(offsets) - 1
+            blob.extend(str(text).encode('utf-8'))
+            offsets.append(len(blob))
+        return index
+
+    if leaderboard_items is None:
+        leaderboard_items = state['leaderboard_data'].items()
+
+    chat_settings = state['chat_settings']
+    quote_counts = state['quote_counts']
+    subscribed = state.get('subscribed_chats', set())
+    schedules = state.get('chat_schedules', {})
+    last_sent = state.get('last_quote_times', {})
+    chats = bytearray()
+    for chat_id in set(chat_settings) | set(quote_counts) | set(subscribed) | set(schedules) | set(last_sent):
+        send_type = chat_settings.get(chat_id)
+        chats += CHAT.pack(chat_id, quote_counts.get(chat_id, 0),
+                           intern(send_type) if send_type is not None else -1,
+                           chat_id in subscribed, schedules.get(chat_id, 0), last_sent.get(chat_id, 0))
+
+    stats = bytearray()
+    stat_count = 0
+    for user_id, per_chat in state['user_stats'].items():
+        for chat_id, entry in per_chat.items():
+            stats += STAT.pack(user_id, chat_id, intern(entry.get('join_date', 'N/A')),
+                               entry.get('reactions_given', 0), entry.get('quote_requests', 0))
+            stat_count += 1
+
+    blocks = bytearray()
+    index = bytearray()
+    index_count = 0
+    for chat_id, users in leaderboard_items:
+        start = len(blocks)
+        for user_id, data in users.items():
+            daily = data.get('daily', {})
+            weekly = data.get('weekly', {})
+            blocks += USER.pack(user_id, intern(data.get('name', 'User')), data.get('overall', 0),
+                                len(daily), len(weekly))
+            for key, count in list(daily.items()) + list(weekly.items()):
+                blocks += BUCKET.pack(intern(key), count)
+        index += INDEX.pack(chat_id, start, len(blocks) - start)
+        index_count += 1
+
+    name_offsets = struct.pack(f"<{len(offsets)}I", *offsets)
+    sections = [
+        (blob, len(blob)),
+        (name_offsets, len(offsets)),
+        (chats, len(chats) // CHAT.size),
+        (stats, stat_count),
+        (index, index_count),
+    ]
+    position = HEADER.size
+    header_fields = []
+    for data, count in sections:
+        header_fields += [position, count]
+        position += len(data)
+    blocks_offset = position
+    # Leaderboard blocks go last so their offsets are relative to blocks_offset
+    header = HEADER.pack(MAGIC, VERSION, journal_seq, state['total_quote_count'], *header_fields)
+    out = bytearray(header)
+    for data, _ in sections:
+        out += data
+    assert len(out) == blocks_offset
+    out += blocks
+    return bytes(out)
+
+
+class SnapshotReader:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = HEADER.unpack_from(self._mmap, 0)
+        magic, version, self.journal_seq, self.total_quote_count = fields[:4]
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError(f"{path} is not a version 1-{VERSION} snapshot")
+        self._chat = CHAT if version == VERSION else CHAT_V1
+        (self._blob_offset, _, self._names_offset, self._name_count,
+         self._chats_offset, self._chat_count, self._stats_offset, self._stat_count,
+         index_offset, index_count) = fields[4:]
+        view = memoryview(self._mmap)
+        self._name_offsets = view[self._names_offset:self._names_offset + 4 * self._name_count].cast('I')
+        self._blocks_offset = index_offset + index_count * INDEX.size
+        self._index = {
+            chat_id: (offset, length)
+            for chat_id, offset, length in INDEX.iter_unpack(view[index_offset:self._blocks_offset])
+        }
+        self._name_cache = {}
+
+    def close(self):
+        self._name_offsets.release()
+        self._mmap.close()
+        self._file.close()
+
+    def name(self, index):
+        text = self._name_cache.get(index)
+        if text is None:
+            start = self._blob_offset + self._name_offsets[index]
+            end = self._blob_offset + self._name_offsets[index + 1]
+            text = self._mmap[start:end].decode('utf-8')
+            if len(self._name_cache) < 4096:
+                self._name_cache[index] = text
+        return text
+
+    def chat_ids(self):
+        return list(self._index)
+
+    def leaderboard(self, chat_id):
+        offset, length = self._index[chat_id]
+        position = self._blocks_offset + offset
+        end = position + length
+        users = {}
+        while position < end:
+            user_id, name_index, overall, n_daily, n_weekly = USER.unpack_from(self._mmap, position)
+            position += USER.size
+            buckets = [BUCKET.unpack_from(self._mmap, position + i * BUCKET.size)
+                       for i in range(n_daily + n_weekly)]
+            position += len(buckets) * BUCKET.size
+            users[user_id] = {
+                "name": self.name(name_index),
+                "daily": {self.name(k): v for k, v in buckets[:n_daily]},
+                "weekly": {self.name(k): v for k, v in buckets[n_daily:]},
+                "overall": overall
+            }
+        return users
+
+    def quote_counts_and_settings(self):
+        quote_counts = {}
+        chat_settings = {}
+        for chat_id, count, setting, *_ in self._chats():
+            if count:
+                quote_counts[chat_id] = count
+            if setting >= 0:
+                chat_settings[chat_id] = self.name(setting)
+        return quote_counts, chat_settings
+
+    def _chats(self):
+        end = self._chats_offset + self._chat_count * self._chat.size
+        return self._chat.iter_unpack(self._mmap[self._chats_offset:end])
+
+    def schedules(self):
+        subscribed_chats = set()
+        chat_schedules = {}
+        last_quote_times = {}
+        if self._chat is CHAT_V1:
+            return subscribed_chats, chat_schedules, last_quote_times
+        for chat_id, _, _, subscribed, interval, last_sent in self._chats():
+            if subscribed:
+                subscribed_chats.add(chat_id)
+            if interval:
+                chat_schedules[chat_id] = interval
+            if last_sent:
+                last_quote_times[chat_id] = last_sent
+        return subscribed_chats, chat_schedules, last_quote_times
+
+    def user_stats(self):
+        user_stats = {}
+        end = self._stats_offset + self._stat_count * STAT.size
+        for user_id, chat_id, join_index, reactions, requests in STAT.iter_unpack(self._mmap[self._stats_offset:end]):
+            user_stats.setdefault(user_id, {})[chat_id] = {
+                'join_date': self.name(join_index),
+                'reactions_given': reactions,
+                'quote_requests': requests
+            }
+        return user_stats
+
+    def to_state(self):
+        quote_counts, chat_settings = self.quote_counts_and_settings()
+        subscribed_chats, chat_schedules, last_quote_times = self.schedules()
+        return {
+            'leaderboard_data': {chat_id: self.leaderboard(chat_id) for chat_id in self._index},
+            'quote_counts': quote_counts,
+            'chat_settings': chat_settings,
+            'total_quote_count': self.total_quote_count,
+            'user_stats': self.user_stats(),
+            'subscribed_chats': sorted(subscribed_chats),
+            'chat_schedules': chat_schedules,
+            'last_quote_times': last_quote_times
+        }
+
+
+def write_binary_snapshot(path, data):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+# Converters between the JSON and binary layouts
+def json_to_binary(src, dst):
+    with open(src, 'r') as f:
+        raw = json.load(f)
+    write_binary_snapshot(dst, encode_snapshot(normalize_state(raw), journal_seq=raw.get('journal_seq', 0)))
+
+
+def binary_to_json(src, dst):
+    reader = SnapshotReader(src)
+    try:
+        state = reader.to_state()
+        state['journal_seq'] = reader.journal_seq
+    finally:
+        reader.close()
+    with open(dst, 'w') as f:
+        json.dump(state, f)
+
+
+def synthetic_state(chats, users, days=7):
+    rng = random.Random(42)
+    day_keys = [f"2024-01-{d:02d}" for d in range(1, days + 1)]
+    state = normalize_state({})
+    for c in range(chats):
+        chat_id = -1000000000000 - c
+        state['chat_settings'][chat_id] = rng.choice(['text', 'img'])
+        state['quote_counts'][chat_id] = rng.randint(0, 500)
+        state['last_quote_times'][chat_id] = 1704067200 + rng.randint(0, 86400)
+        state['leaderboard_data'][chat_id] = {}
+        for u in range(users):
+            user_id = 100000 + rng.randint(0, chats * users)
+            daily = {k: rng.randint(1, 50) for k in day_keys if rng.random() < 0.5}
+            state['leaderboard_data'][chat_id][user_id] = {
+                "name": f"User {user_id}",
+                "daily": daily,
+                "weekly": {"2024-W01": sum(daily.values())},
+                "overall": rng.randint(1, 10000)
+            }
+            state['user_stats'].setdefault(user_id, {})[chat_id] = {
+                'join_date': "2024-01-01T00:00:00",
+                'reactions_given': rng.randint(0, 100),
+                'quote_requests': rng.randint(0, 100)
+            }
+    state['total_quote_count'] = sum(state['quote_counts'].values())
+    # Stored as a list, the way the bot writes its JSON snapshots
+    state['subscribed_chats'] = sorted(state['last_quote_times'])
+    return state
+
+
+# Startup benchmark: JSON load versus binary open (lazy) and full decode
+def bench(src=None, chats=2000, users=50, rounds=5):
+    workdir = tempfile.mkdtemp(prefix="snapshot-bench-")
+    json_path = os.path.join(workdir, "bot_data.json")
+    bin_path = os.path.join(workdir, "bot_data.snap")
+    if src:
+        with open(src, 'rb') as f_in, open(json_path, 'wb') as f_out:
+            f_out.write(f_in.read())
+    else:
+        with open(json_path, 'w') as f:
+            json.dump(synthetic_state(chats, users), f)
+    json_to_binary(json_path, bin_path)
+
+    def timed(func):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    def load_json():
+        with open(json_path, 'r') as f:
+            normalize_state(json.load(f))
+
+    def open_lazy():
+        reader = SnapshotReader(bin_path)
+        reader.quote_counts_and_settings()
+        reader.user_stats()
+        reader.close()
+
+    def open_lazy_one_chat():
+        reader = SnapshotReader(bin_path)
+        reader.leaderboard(reader.chat_ids()[0])
+        reader.close()
+
+    def decode_all():
+        reader = SnapshotReader(bin_path)
+        reader.to_state()
+        reader.close()
+
+    print(f"JSON snapshot:   {os.path.getsize(json_path):>12,} bytes")
+    print(f"Binary snapshot: {os.path.getsize(bin_path):>12,} bytes")
+    print(f"json.load + normalize:           {timed(load_json):9.1f} ms")
+    print(f"binary open (settings + stats):  {timed(open_lazy):9.1f} ms")
+    print(f"binary open + one chat:          {timed(open_lazy_one_chat):9.1f} ms")
+    print(f"binary full decode:              {timed(decode_all):9.1f} ms")
+    for path in (json_path, bin_path):
+        os.remove(path)
+    os.rmdir(workdir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert and benchmark bot state snapshots")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("to-binary", help="convert bot_data.json to the binary format")
+    p.add_argument("src")
+    p.add_argument("dst")
+    p = sub.add_parser("to-json", help="convert a binary snapshot back to JSON")
+    p.add_argument("src")
+    p.add_argument("dst")
+    p = sub.add_parser("bench", help="compare startup cost of both formats")
+    p.add_argument("src", nargs="?", help="existing bot_data.json (default: synthetic data)")
+    p.add_argument("--chats", type=int, default=2000)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == "to-binary":
+        json_to_binary(args.src, args.dst)
+    elif args.command == "to-json":
+        binary_to_json(args.src, args.dst)
+    else:
+        bench(args.src, args.chats, args.users, args.rounds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,805 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind persistence: callers only mark state dirty, a background thread
+# flushes it on a fixed interval or as soon as enough changes have piled up.
+class WriteBehind:
+    def __init__(self, flush_func, interval=5, max_dirty=100):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.dirty = 0
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="WriteBehind", daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind started (interval {self.interval}s, threshold {self.max_dirty})")
+
+    def mark_dirty(self, count=1):
+        with self._lock:
+            self.dirty += count
+            full = self.dirty >= self.max_dirty
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = self.dirty
+                self.dirty = 0
+            if not pending:
+                return True
+            try:
+                ok = self.flush_func() is not False
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}")
+                ok = False
+            if not ok:
+                # Keep the changes pending so the next tick retries them
+                with self._lock:
+                    self.dirty += pending
+                return False
+            self.flushes += 1
+            return True
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        self._thread = None
+        return self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            self.flush()
+
+
+# JSON object keys are always strings; chat and user ids are ints everywhere else
+def _int_key(key):
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        return key
+
+def normalize_state(data):
+    leaderboard_data = {
+        _int_key(chat_id): {_int_key(user_id): entry for user_id, entry in users.items()}
+        for chat_id, users in data.get('leaderboard_data', {}).items()
+    }
+    user_stats = {
+        _int_key(user_id): {_int_key(chat_id): entry for chat_id, entry in chats.items()}
+        for user_id, chats in data.get('user_stats', {}).items()
+    }
+    return {
+        'leaderboard_data': leaderboard_data,
+        'quote_counts': {_int_key(k): v for k, v in data.get('quote_counts', {}).items()},
+        'chat_settings': {_int_key(k): v for k, v in data.get('chat_settings', {}).items()},
+        'total_quote_count': data.get('total_quote_count', 0),
+        'user_stats': user_stats,
+        'subscribed_chats': {_int_key(chat_id) for chat_id in data.get('subscribed_chats', [])},
+        'chat_schedules': {_int_key(k): v for k, v in data.get('chat_schedules', {}).items()},
+        'last_quote_times': {_int_key(k): v for k, v in data.get('last_quote_times', {}).items()}
+    }
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leaderboard (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    overall INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_leaderboard_overall ON leaderboard (chat_id, overall DESC);
+
+CREATE TABLE IF NOT EXISTS leaderboard_buckets (
+    chat_id INTEGER NOT NULL,
+    period TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, period, bucket, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_buckets_rank ON leaderboard_buckets (chat_id, period, bucket, count DESC);
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    join_date TEXT NOT NULL,
+    reactions_given INTEGER NOT NULL DEFAULT 0,
+    quote_requests INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, chat_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id INTEGER PRIMARY KEY,
+    send_type TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS quote_counts (
+    chat_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS chat_schedules (
+    chat_id INTEGER PRIMARY KEY,
+    subscribed INTEGER NOT NULL DEFAULT 0,
+    interval INTEGER,
+    last_sent REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# SQLite (WAL) backend. Every state event becomes a handful of single-row
+# upserts on one shared connection; WriteBehind decides when to commit.
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self.conn.commit()
+        logger.info(f"SQLite store opened at {path}")
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+        return True
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, str(value))
+        )
+
+    def apply(self, event):
+        kind = event[0]
+        with self._lock:
+            c = self.conn
+            if kind == 'message':
+                _, chat_id, user_id, name, day, week = event
+                c.execute(
+                    "INSERT INTO leaderboard (chat_id, user_id, name, overall) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (chat_id, user_id) DO UPDATE SET name = excluded.name, overall = overall + 1",
+                    (chat_id, user_id, name)
+                )
+                for period, bucket in (('daily', day), ('weekly', week)):
+                    c.execute(
+                        "INSERT INTO leaderboard_buckets (chat_id, period, bucket, user_id, count) VALUES (?, ?, ?, ?, 1) "
+                        "ON CONFLICT (chat_id, period, bucket, user_id) DO UPDATE SET count = count + 1",
+                        (chat_id, period, bucket, user_id)
+                    )
+            elif kind == 'user_stat':
+                _, user_id, chat_id, field, join_date = event
+                reactions = 1 if field == 'reactions_given' else 0
+                requests = 1 if field == 'quote_requests' else 0
+                c.execute(
+                    "INSERT INTO user_stats (user_id, chat_id, join_date, reactions_given, quote_requests) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (user_id, chat_id) DO UPDATE SET "
+                    "reactions_given = reactions_given + excluded.reactions_given, "
+                    "quote_requests = quote_requests + excluded.quote_requests",
+                    (user_id, chat_id, join_date, reactions, requests)
+                )
+            elif kind == 'quote':
+                _, chat_id = event
+                c.execute(
+                    "INSERT INTO quote_counts (chat_id, count) VALUES (?, 1) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET count = count + 1",
+                    (chat_id,)
+                )
+                c.execute(
+                    "INSERT INTO meta (key, value) VALUES ('total_quote_count', '1') "
+                    "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+                )
+            elif kind == 'setting':
+                _, chat_id, send_type = event
+                c.execute(
+                    "INSERT INTO chat_settings (chat_id, send_type) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET send_type = excluded.send_type",
+                    (chat_id, send_type)
+                )
+            elif kind == 'forget_chat':
+                _, chat_id = event
+                c.execute("DELETE FROM leaderboard WHERE chat_id = ?", (chat_id,))
+                c.execute("DELETE FROM leaderboard_buckets WHERE chat_id = ?", (chat_id,))
+                c.execute("DELETE FROM quote_counts WHERE chat_id = ?", (chat_id,))
+                c.execute("DELETE FROM chat_schedules WHERE chat_id = ?", (chat_id,))
+            elif kind == 'subscription':
+                _, chat_id, subscribed = event
+                c.execute(
+                    "INSERT INTO chat_schedules (chat_id, subscribed) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET subscribed = excluded.subscribed",
+                    (chat_id, int(subscribed))
+                )
+            elif kind == 'interval':
+                _, chat_id, interval = event
+                c.execute(
+                    "INSERT INTO chat_schedules (chat_id, interval) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET interval = excluded.interval, last_sent = 0",
+                    (chat_id, interval)
+                )
+            elif kind == 'sent':
+                _, chat_id, sent_at = event
+                c.execute(
+                    "INSERT INTO chat_schedules (chat_id, last_sent) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET last_sent = excluded.last_sent",
+                    (chat_id, sent_at)
+                )
+            elif kind == 'prune':
+                _, day, week = event
+                c.execute("DELETE FROM leaderboard_buckets WHERE period = 'daily' AND bucket < ?", (day,))
+                c.execute("DELETE FROM leaderboard_buckets WHERE period = 'weekly' AND bucket < ?", (week,))
+            else:
+                logger.warning(f"Unknown storage event: {kind}")
+
+    # Leaderboard queries, served from the ranking indexes
+    def top_users(self, chat_id, mode="overall", bucket=None, limit=10):
+        with self._lock:
+            if mode == "overall":
+                rows = self.conn.execute(
+                    "SELECT name, overall FROM leaderboard WHERE chat_id = ? AND overall > 0 "
+                    "ORDER BY overall DESC LIMIT ?",
+                    (chat_id, limit)
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT l.name, b.count FROM leaderboard_buckets b "
+                    "JOIN leaderboard l ON l.chat_id = b.chat_id AND l.user_id = b.user_id "
+                    "WHERE b.chat_id = ? AND b.period = ? AND b.bucket = ? AND b.count > 0 "
+                    "ORDER BY b.count DESC LIMIT ?",
+                    (chat_id, mode, bucket, limit)
+                ).fetchall()
+        return rows
+
+    def user_count(self, chat_id):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM leaderboard WHERE chat_id = ?", (chat_id,)
+            ).fetchone()[0]
+
+    def load(self):
+        with self._lock:
+            c = self.conn
+            leaderboard_data = {}
+            for chat_id, user_id, name, overall in c.execute(
+                    "SELECT chat_id, user_id, name, overall FROM leaderboard"):
+                leaderboard_data.setdefault(chat_id, {})[user_id] = {
+                    "name": name, "daily": {}, "weekly": {}, "overall": overall
+                }
+            for chat_id, period, bucket, user_id, count in c.execute(
+                    "SELECT chat_id, period, bucket, user_id, count FROM leaderboard_buckets"):
+                entry = leaderboard_data.get(chat_id, {}).get(user_id)
+                if entry is not None:
+                    entry[period][bucket] = count
+            user_stats = {}
+            for user_id, chat_id, join_date, reactions, requests in c.execute(
+                    "SELECT user_id, chat_id, join_date, reactions_given, quote_requests FROM user_stats"):
+                user_stats.setdefault(user_id, {})[chat_id] = {
+                    'join_date': join_date,
+                    'reactions_given': reactions,
+                    'quote_requests': requests
+                }
+            subscribed_chats = set()
+            chat_schedules = {}
+            last_quote_times = {}
+            for chat_id, subscribed, interval, last_sent in c.execute(
+                    "SELECT chat_id, subscribed, interval, last_sent FROM chat_schedules"):
+                if subscribed:
+                    subscribed_chats.add(chat_id)
+                if interval is not None:
+                    chat_schedules[chat_id] = interval
+                if last_sent:
+                    last_quote_times[chat_id] = last_sent
+            return {
+                'leaderboard_data': leaderboard_data,
+                'quote_counts': dict(c.execute("SELECT chat_id, count FROM quote_counts")),
+                'chat_settings': dict(c.execute("SELECT chat_id, send_type FROM chat_settings")),
+                'total_quote_count': int(self._get_meta('total_quote_count', 0)),
+                'user_stats': user_stats,
+                'subscribed_chats': subscribed_chats,
+                'chat_schedules': chat_schedules,
+                'last_quote_times': last_quote_times
+            }
+
+    # One-time import of the legacy bot_data.json layout
+    def migrate_json(self, json_path):
+        with self._lock:
+            if self._get_meta('json_migrated') or not os.path.exists(json_path):
+                return False
+            with open(json_path, 'r') as f:
+                data = normalize_state(json.load(f))
+            c = self.conn
+            for chat_id, users in data['leaderboard_data'].items():
+                for user_id, entry in users.items():
+                    c.execute(
+                        "INSERT OR REPLACE INTO leaderboard (chat_id, user_id, name, overall) VALUES (?, ?, ?, ?)",
+                        (chat_id, user_id, entry.get('name', 'User'), entry.get('overall', 0))
+                    )
+                    for period in ('daily', 'weekly'):
+                        for bucket, count in entry.get(period, {}).items():
+                            c.execute(
+                                "INSERT OR REPLACE INTO leaderboard_buckets (chat_id, period, bucket, user_id, count) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                (chat_id, period, bucket, user_id, count)
+                            )
+            for user_id, chats in data['user_stats'].items():
+                for chat_id, stats in chats.items():
+                    c.execute(
+                        "INSERT OR REPLACE INTO user_stats (user_id, chat_id, join_date, reactions_given, quote_requests) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (user_id, chat_id, stats.get('join_date', 'N/A'),
+                         stats.get('reactions_given', 0), stats.get('quote_requests', 0))
+                    )
+            c.executemany(
+                "INSERT OR REPLACE INTO chat_settings (chat_id, send_type) VALUES (?, ?)",
+                data['chat_settings'].items()
+            )
+            c.executemany(
+                "INSERT OR REPLACE INTO quote_counts (chat_id, count) VALUES (?, ?)",
+                data['quote_counts'].items()
+            )
+            schedule_chats = data['subscribed_chats'] | set(data['chat_schedules']) | set(data['last_quote_times'])
+            c.executemany(
+                "INSERT OR REPLACE INTO chat_schedules (chat_id, subscribed, interval, last_sent) VALUES (?, ?, ?, ?)",
+                [(chat_id, int(chat_id in data['subscribed_chats']), data['chat_schedules'].get(chat_id),
+                  data['last_quote_times'].get(chat_id, 0)) for chat_id in schedule_chats]
+            )
+            self._set_meta('total_quote_count', data['total_quote_count'])
+            self._set_meta('json_migrated', json_path)
+            c.commit()
+        logger.info(f"Migrated {json_path} into SQLite store")
+        return True
+
+
+# Append-only journal of state events. Each event is one short JSON line; the
+# journal is split into numbered segments so a compactor can fold sealed
+# segments into a snapshot and drop them.
+JOURNAL_CODES = {
+    'message': 'm',
+    'user_stat': 'u',
+    'quote': 'q',
+    'setting': 's',
+    'forget_chat': 'f',
+    'prune': 'p',
+    'subscription': 'b',
+    'interval': 'i',
+    'sent': 't'
+}
+JOURNAL_KINDS = {code: kind for kind, code in JOURNAL_CODES.items()}
+
+
+class Journal:
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.seq = 0
+        self.size = 0
+        self.pending = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _segment_path(self, seq):
+        return f"{self.base_path}.{seq}"
+
+    def segments(self):
+        directory = os.path.dirname(self.base_path) or "."
+        prefix = os.path.basename(self.base_path) + "."
+        found = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                found.append(int(name[len(prefix):]))
+        return sorted(found)
+
+    def replay(self, after_seq=0):
+        for seq in self.segments():
+            if seq <= after_seq:
+                continue
+            with open(self._segment_path(seq), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn tail from a crash mid-batch; nothing after it was synced
+                        logger.warning(f"Skipping torn journal record in segment {seq}")
+                        break
+                    yield seq, (JOURNAL_KINDS.get(record[0], record[0]),) + tuple(record[1:])
+
+    def open(self, min_seq=0):
+        with self._lock:
+            self.seq = max(self.segments() + [min_seq, self.seq]) + 1
+            self._file = open(self._segment_path(self.seq), 'a', encoding='utf-8')
+            self.size = 0
+        logger.info(f"Journal segment {self.seq} opened")
+
+    def append(self, event):
+        line = json.dumps([JOURNAL_CODES.get(event[0], event[0])] + list(event[1:]),
+                          separators=(',', ':'), ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.size += len(line)
+            self.pending += 1
+
+    def sync(self):
+        with self._lock:
+            if self._file is None:
+                return True
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending = 0
+        return True
+
+    # Seal the current segment and start a new one; returns the sealed seq
+    def rotate(self):
+        with self._lock:
+            sealed = self.seq
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+            self.seq += 1
+            self._file = open(self._segment_path(self.seq), 'a', encoding='utf-8')
+            self.size = 0
+            self.pending = 0
+        return sealed
+
+    def discard_through(self, seq):
+        for old_seq in self.segments():
+            if old_seq <= seq:
+                try:
+                    os.remove(self._segment_path(old_seq))
+                except OSError as e:
+                    logger.error(f"Journal segment {old_seq} removal error: {e}")
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Chat-keyed mapping whose values are materialized on first access from a
+# loader (e.g. a memory-mapped snapshot); unloaded chats cost one set entry.
+class LazyChatMap(MutableMapping):
+    def __init__(self, loader=None, keys=()):
+        self._data = {}
+        self._loader = loader
+        self._pending = set(keys)
+        self._lock = threading.Lock()
+
+    def set_loader(self, loader):
+        with self._lock:
+            self._loader = loader
+
+    def _load(self, key):
+        with self._lock:
+            if key in self._pending:
+                self._data[key] = self._loader(key)
+                self._pending.discard(key)
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._load(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._pending.discard(key)
+            self._data[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key in self._pending:
+                self._pending.discard(key)
+                self._data.pop(key, None)
+            else:
+                del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data or key in self._pending
+
+    def __iter__(self):
+        return iter(list(self._data) + list(self._pending))
+
+    def __len__(self):
+        return len(self._data) + len(self._pending)
+
+    def loaded_values(self):
+        return list(self._data.values())
+
+    # Read a chat without keeping it in memory
+    def peek(self, key):
+        value = self._data.get(key)
+        if value is None and key in self._pending:
+            return self._loader(key)
+        return value
+
+    def snapshot_items(self):
+        for key in list(self):
+            value = self.peek(key)
+            if value is not None:
+                yield key, value
+
+
+# Per-chat state shards on disk. A shard holds everything the bot keeps about
+# one chat; shards are loaded on first access and evicted once idle or when
+# more than max_chats are resident. Dirty shards are only written (and become
+# evictable) at compaction, tagged with the journal segment they include.
+def new_shard():
+    return {
+        'leaderboard': {},
+        'user_stats': {},
+        'latest_quote': None,
+        'start_message_id': None,
+        'help_message_id': None,
+        'journal_seq': 0
+    }
+
+
+class ChatShards:
+    def __init__(self, directory, max_chats=500, idle_seconds=1800):
+        self.directory = directory
+        self.max_chats = max_chats
+        self.idle_seconds = idle_seconds
+        self.on_load = None
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()
+        self._last_used = {}
+        self._dirty = set()
+        self._writing = set()
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._known = set()
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                self._known.add(_int_key(name[:-5]))
+
+    def _path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    def _read(self, chat_id):
+        with open(self._path(chat_id), 'r') as f:
+            raw = json.load(f)
+        shard = new_shard()
+        shard.update(raw)
+        shard['leaderboard'] = {_int_key(k): v for k, v in shard['leaderboard'].items()}
+        shard['user_stats'] = {_int_key(k): v for k, v in shard['user_stats'].items()}
+        return shard
+
+    def __contains__(self, chat_id):
+        return chat_id in self._known
+
+    def chat_ids(self):
+        return list(self._known)
+
+    def loaded_count(self):
+        return len(self._loaded)
+
+    def get(self, chat_id, create=False):
+        with self._lock:
+            shard = self._loaded.get(chat_id)
+            if shard is not None:
+                self._loaded.move_to_end(chat_id)
+                self._last_used[chat_id] = time.monotonic()
+                return shard
+            if chat_id in self._known:
+                try:
+                    shard = self._read(chat_id)
+                except Exception as e:
+                    logger.error(f"Shard load error for chat {chat_id}: {e}")
+                    shard = new_shard()
+                if self.on_load is not None:
+                    self.on_load(shard)
+                self.loads += 1
+            elif create:
+                shard = new_shard()
+                self._known.add(chat_id)
+            else:
+                return None
+            self._loaded[chat_id] = shard
+            self._last_used[chat_id] = time.monotonic()
+            return shard
+
+    def put(self, chat_id, shard):
+        with self._lock:
+            self._known.add(chat_id)
+            self._loaded[chat_id] = shard
+            self._last_used[chat_id] = time.monotonic()
+            self._dirty.add(chat_id)
+
+    def mark_dirty(self, chat_id):
+        with self._lock:
+            self._dirty.add(chat_id)
+
+    def applied_seq(self, chat_id):
+        shard = self.get(chat_id)
+        return shard['journal_seq'] if shard is not None else 0
+
+    def loaded_shards(self):
+        with self._lock:
+            return list(self._loaded.values())
+
+    def drop(self, chat_id):
+        with self._lock:
+            self._loaded.pop(chat_id, None)
+            self._last_used.pop(chat_id, None)
+            self._dirty.discard(chat_id)
+            self._known.discard(chat_id)
+            try:
+                os.remove(self._path(chat_id))
+            except FileNotFoundError:
+                pass
+
+    def reset(self):
+        with self._lock:
+            for chat_id in list(self._known):
+                self.drop(chat_id)
+
+    # Serialize dirty shards (call with writers blocked); write_dumped() does the I/O
+    def dump_dirty(self, journal_seq):
+        with self._lock:
+            dumped = []
+            for chat_id in self._dirty:
+                shard = self._loaded.get(chat_id)
+                if shard is None:
+                    continue
+                shard['journal_seq'] = journal_seq
+                dumped.append((chat_id, json.dumps(shard)))
+            self._writing.update(chat_id for chat_id, _ in dumped)
+            self._dirty.clear()
+            return dumped
+
+    def write_dumped(self, dumped):
+        try:
+            for chat_id, payload in dumped:
+                path = self._path(chat_id)
+                with open(path + ".tmp", 'w') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + ".tmp", path)
+        finally:
+            with self._lock:
+                self._writing.difference_update(chat_id for chat_id, _ in dumped)
+
+    def over_budget(self):
+        return len(self._loaded) > self.max_chats
+
+    # Drop clean shards, least recently used first. Callers must hold the
+    # lock that serializes state mutations so no half-applied update is lost.
+    def evict(self):
+        with self._lock:
+            now = time.monotonic()
+            for chat_id in list(self._loaded):
+                if chat_id in self._dirty or chat_id in self._writing:
+                    continue
+                idle = now - self._last_used.get(chat_id, now) >= self.idle_seconds
+                if idle or len(self._loaded) > self.max_chats:
+                    del self._loaded[chat_id]
+                    self._last_used.pop(chat_id, None)
+                    self.evictions += 1
+
+    def read_all(self):
+        with self._lock:
+            return {chat_id: self._loaded.get(chat_id) or self._read(chat_id)
+                    for chat_id in list(self._known)}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'chats': len(self._known),
+                'loaded': self.loaded_count(),
+                'max_loaded': self.max_chats,
+                'dirty': len(self._dirty),
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+
+# Chat-keyed view of one shard field, so handlers keep using dict-style access
+class ShardField(MutableMapping):
+    def __init__(self, shards, field):
+        self.shards = shards
+        self.field = field
+
+    def __getitem__(self, chat_id):
+        shard = self.shards.get(chat_id)
+        if shard is None or shard[self.field] is None:
+            raise KeyError(chat_id)
+        return shard[self.field]
+
+    def __setitem__(self, chat_id, value):
+        with self.shards._lock:
+            shard = self.shards.get(chat_id, create=True)
+            shard[self.field] = value
+            self.shards.mark_dirty(chat_id)
+
+    def __delitem__(self, chat_id):
+        with self.shards._lock:
+            shard = self.shards.get(chat_id)
+            if shard is None or shard[self.field] is None:
+                raise KeyError(chat_id)
+            shard[self.field] = {} if self.field == 'leaderboard' else None
+            self.shards.mark_dirty(chat_id)
+
+    def __contains__(self, chat_id):
+        if chat_id not in self.shards:
+            return False
+        return self.shards.get(chat_id)[self.field] is not None
+
+    def __iter__(self):
+        return (chat_id for chat_id in self.shards.chat_ids() if chat_id in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# user_stats is keyed user -> chat but stored per chat shard; this view supports
+# the user_stats.get(user_id, {}).get(chat_id) / setdefault() access pattern.
+class ShardUserStats:
+    def __init__(self, shards):
+        self.shards = shards
+
+    def get(self, user_id, default=None):
+        return _ShardUserChats(self.shards, user_id)
+
+    def setdefault(self, user_id, default=None):
+        return _ShardUserChats(self.shards, user_id)
+
+
+class _ShardUserChats:
+    def __init__(self, shards, user_id):
+        self.shards = shards
+        self.user_id = user_id
+
+    def get(self, chat_id, default=None):
+        shard = self.shards.get(chat_id)
+        if shard is None:
+            return default
+        return shard['user_stats'].get(self.user_id, default)
+
+    def setdefault(self, chat_id, default=None):
+        with self.shards._lock:
+            shard = self.shards.get(chat_id, create=True)
+            self.shards.mark_dirty(chat_id)
+            return shard['user_stats'].setdefault(self.user_id, default)